@@ -0,0 +1,322 @@
+""" ตัวแทนของ Discord, OpenAI และ PostgreSQL สำหรับรัน benchmark แบบ offline """
+import asyncio
+import itertools
+import json
+import random
+import time
+
+# ----------------------------------------------------------------------------
+# Fake OpenAI server (HTTP จริง ใช้กับ openai.AsyncOpenAI ผ่าน base_url)
+# ----------------------------------------------------------------------------
+
+class FakeOpenAIServer:
+    """ HTTP server ที่ตอบ /v1/chat/completions และ /v1/models แบบเดียวกับ OpenAI
+
+    ตั้งค่าเวลาก่อน token แรก (latency), จำนวน token, ช่วงห่างระหว่าง token
+    และโอกาสที่จะตอบ 429 ได้ รองรับทั้งแบบ stream (SSE) และไม่ stream
+    """
+
+    def __init__(self, latency=0.4, tokens=120, token_interval=0.01, rate_429=0.0, retry_after_ms=200, seed=0):
+        self.latency = latency
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.rate_429 = rate_429
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.rejected = 0
+        self._server = None
+        self._connections = set()  # task ของ connection ที่ยังเปิดอยู่ (keep-alive)
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # connection แบบ keep-alive ยังรอ request ถัดไปอยู่ ต้องปิดเองก่อน loop จบ
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            # httpx ใช้ keep-alive จึงต้องอ่านหลาย request ต่อ connection
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0") or 0))
+                await self._route(method, path.split("?")[0], body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+    async def _route(self, method, path, body, writer):
+        if path.endswith("/models"):
+            await self._send_json(writer, 200, {
+                "object": "list",
+                "data": [{"id": "gpt-4o-mini", "object": "model", "created": 0, "owned_by": "bench"}],
+            })
+            return
+        if not path.endswith("/chat/completions"):
+            await self._send_json(writer, 404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+
+        self.requests += 1
+        if self.random.random() < self.rate_429:
+            self.rejected += 1
+            await self._send_json(writer, 429, {
+                "error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"},
+            }, extra_headers={"retry-after-ms": str(self.retry_after_ms)})
+            return
+
+        request = json.loads(body or b"{}")
+        prompt_tokens = sum(len(m.get("content") or "") // 2 + 4 for m in request.get("messages", []))
+        tokens = min(self.tokens, request.get("max_tokens") or self.tokens)
+        words = [f"คำ{i % 10} " for i in range(tokens)]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": prompt_tokens + tokens}
+
+        await asyncio.sleep(self.latency)
+        if request.get("stream"):
+            await self._stream(writer, request, words, usage)
+        else:
+            await asyncio.sleep(self.token_interval * tokens)
+            await self._send_json(writer, 200, {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-4o-mini"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+    async def _stream(self, writer, request, words, usage):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n"
+        )
+
+        def chunk(choices, **extra):
+            payload = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-4o-mini"),
+                "choices": choices,
+                **extra,
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+        async def send(data):
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            await writer.drain()
+
+        await send(chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]))
+        for word in words:
+            await send(chunk([{"index": 0, "delta": {"content": word}, "finish_reason": None}]))
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval)
+        await send(chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            await send(chunk([], usage=usage))
+        await send(b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _send_json(self, writer, status, payload, extra_headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests"}.get(status, "Error")
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (extra_headers or {}).items())
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n{headers}\r\n".encode() + body
+        )
+        await writer.drain()
+
+# ----------------------------------------------------------------------------
+# Stub ของ asyncpg pool (เฉพาะคำสั่งที่ main.py ใช้)
+# ----------------------------------------------------------------------------
+
+class FakeTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def _delay(self):
+        self.pool.queries += 1
+        if self.pool.latency:
+            await asyncio.sleep(self.pool.latency)
+
+    def transaction(self):
+        return FakeTransaction()
+
+    async def execute(self, query, *args):
+        await self._delay()
+        return "OK"
+
+    async def fetch(self, query, *args):
+        await self._delay()
+        # คำสั่งดึงข้อความล่าสุดของ get_guild_x (guild, channel, limit)
+        if "FROM chat_messages" in query and "ORDER BY seq DESC" in query and len(args) == 3:
+            guild, channel, limit = args[:3]
+            rows = self.pool.messages.get((guild, channel), [])[-limit:]
+            return [{"seq": seq, "content": content} for seq, content in reversed(rows)]
+        return []
+
+    async def fetchrow(self, query, *args):
+        await self._delay()
+        return None
+
+    async def fetchval(self, query, *args):
+        await self._delay()
+        return None
+
+    async def copy_records_to_table(self, table, records, columns=None):
+        await self._delay()
+        if table == "chat_messages":
+            for guild, channel, content in records:
+                self.pool.messages.setdefault((guild, channel), []).append((next(self.pool.seq), content))
+        return f"COPY {len(records)}"
+
+class FakeAcquire:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        await self.pool.semaphore.acquire()
+        return FakeConnection(self.pool)
+
+    async def __aexit__(self, *exc):
+        self.pool.semaphore.release()
+        return False
+
+class FakePool:
+    """ จำลอง asyncpg pool: จำกัด connection เท่า max_size และหน่วงเวลาทุก query """
+
+    def __init__(self, max_size=10, latency=0.002):
+        self.semaphore = asyncio.Semaphore(max_size)
+        self.latency = latency
+        self.queries = 0
+        self.messages = {}
+        self.seq = itertools.count(1)
+
+    def acquire(self):
+        return FakeAcquire(self)
+
+    async def close(self):
+        pass
+
+# ----------------------------------------------------------------------------
+# วัตถุ Discord ปลอม
+# ----------------------------------------------------------------------------
+
+_ids = itertools.count(1)
+
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.display_name = name
+        self.name = name
+        self.bot = False
+
+    def __str__(self):
+        return self.name
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeSentMessage:
+    def __init__(self, channel, content):
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.latency_sleep()
+        self.content = content
+        self.channel.touch(content)
+        return self
+
+    async def delete(self):
+        await self.channel.latency_sleep()
+
+class FakeChannel:
+    """ ห้องแชทปลอมที่จดเวลาที่ผู้ใช้เห็นข้อความแรกและข้อความล่าสุด """
+
+    def __init__(self, channel_id, latency=0.05, placeholder=None):
+        self.id = channel_id
+        self.latency = latency
+        self.placeholder = placeholder
+        self.sent = []
+        self.first_text_at = None
+        self.last_activity_at = None
+
+    async def latency_sleep(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def touch(self, content):
+        now = time.perf_counter()
+        self.last_activity_at = now
+        if self.first_text_at is None and content and content != self.placeholder:
+            self.first_text_at = now
+
+    async def send(self, content=None, **kwargs):
+        await self.latency_sleep()
+        message = FakeSentMessage(self, content)
+        self.sent.append(message)
+        self.touch(content)
+        return message
+
+class FakeMessage:
+    """ discord.Message ปลอม done จะถูก set เมื่อบอทตอบเสร็จ (หรือตอบว่ายุ่ง) """
+
+    def __init__(self, content, author, guild, channel, busy_text=None):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.busy_text = busy_text
+        self.created_at = time.perf_counter()
+        self.done = asyncio.Event()
+        self.shed = False
+
+    async def reply(self, content=None, **kwargs):
+        message = await self.channel.send(content)
+        if content == self.busy_text:
+            self.shed = True
+        self.done.set()
+        return message
@@ -0,0 +1,272 @@
+""" Benchmark ของ pipeline การตอบข้อความใน main.py แบบ offline
+
+ป้อน discord.Message ปลอมเข้า on_message โดยใช้ fake OpenAI server, fakeredis
+และ stub ของ asyncpg pool แล้ววัด throughput, latency (p50/p99), event-loop lag
+และหน่วยความจำที่ระดับ concurrency ต่างๆ
+
+    python -m bench.run --levels 1,8,32 --save bench/baseline.json
+    python -m bench.run --levels 1,8,32 --compare bench/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUESTIONS = [
+    "python ต่างจาก javascript ยังไง",
+    "วันนี้กินอะไรดีวะ",
+    "ช่วยอธิบาย asyncio ให้หน่อย",
+    "ทำไม bot ตอบช้าจัง",
+    "แนะนำหนังสนุกๆ สักเรื่องดิ",
+]
+WORDS = ["เว้ย", "งาน", "เขียนโค้ด", "ทำไม", "ยังไง", "ช่วย", "หน่อย", "บั๊ก", "ข้าว", "เกม", "python", "discord"]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round((len(values) - 1) * p / 100)))]
+
+def current_rss_mb():
+    """ RSS ปัจจุบันของ process (ไม่ใช่ค่าสูงสุดตลอดอายุ process แบบ ru_maxrss) คืน None ถ้าอ่านไม่ได้ """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="1,8,32,64", help="จำนวนผู้ใช้พร้อมกันแต่ละระดับ คั่นด้วย ,")
+    parser.add_argument("--messages", type=int, default=4, help="จำนวนข้อความต่อผู้ใช้ในแต่ละระดับ")
+    parser.add_argument("--guilds", type=int, default=8, help="จำนวน guild ที่ผู้ใช้กระจายอยู่")
+    parser.add_argument("--repeat-ratio", type=float, default=0.2, help="สัดส่วนข้อความที่เป็นคำถามยอดฮิตซ้ำๆ")
+    parser.add_argument("--think-time", type=float, default=0.05, help="วินาทีที่ผู้ใช้รอก่อนส่งข้อความถัดไป")
+    parser.add_argument("--openai-latency", type=float, default=0.4, help="วินาทีก่อน token แรกจาก OpenAI ปลอม")
+    parser.add_argument("--openai-tokens", type=int, default=120, help="จำนวน token ต่อคำตอบ")
+    parser.add_argument("--token-interval", type=float, default=0.005, help="วินาทีระหว่าง token")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="โอกาสที่ OpenAI ปลอมจะตอบ 429")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="วินาทีต่อการ send/edit ใน Discord ปลอม")
+    parser.add_argument("--pg-latency", type=float, default=0.002, help="วินาทีต่อ query ของ Postgres ปลอม")
+    parser.add_argument("--no-redis", action="store_true", help="ไม่ใช้ fakeredis (ทดสอบ fallback)")
+    parser.add_argument("--trace-memory", action="store_true", help="วัด peak memory ของแต่ละระดับด้วย tracemalloc (ช้าลง)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", metavar="PATH", help="บันทึกผลเป็น baseline JSON")
+    parser.add_argument("--compare", metavar="PATH", help="เทียบกับ baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="สัดส่วนที่แย่ลงได้ก่อนนับว่า regression")
+    return parser.parse_args(argv)
+
+def import_bot(args):
+    """ import main.py ด้วยค่าตั้งที่เหมาะกับ benchmark (ต้องตั้ง env ก่อน import) """
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("DISCORD_TOKEN", "bench")
+    os.environ["METRICS_PORT"] = "0"
+    # ไม่ให้ rate limiter ของบอทเป็นคอขวดของ benchmark
+    os.environ.setdefault("OPENAI_RPM_LIMIT", "1000000")
+    os.environ.setdefault("OPENAI_TPM_LIMIT", "1000000000")
+    sys.path.insert(0, ROOT)
+    import main
+    return main
+
+class EventLoopLagMonitor:
+    """ วัดว่า event loop ตื่นช้ากว่าที่ควรเท่าไร (บอกว่ามีโค้ด blocking หรือ loop ยุ่งเกินไป) """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+async def run_level(main, fakes, args, users, rng):
+    channel_id = main.CHANNEL_ID
+    done = []
+
+    async def user_session(index):
+        author = fakes.FakeUser(10_000 + index, f"user{index}")
+        guild = fakes.FakeGuild(1 + index % args.guilds)
+        for _ in range(args.messages):
+            if rng.random() < args.repeat_ratio:
+                text = rng.choice(QUESTIONS)
+            else:
+                text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 16)))
+            channel = fakes.FakeChannel(channel_id, latency=args.discord_latency, placeholder=main.STREAM_PLACEHOLDER)
+            message = fakes.FakeMessage(text, author, guild, channel, busy_text=main.BUSY_MESSAGE)
+            await main.on_message(message)
+            await message.done.wait()
+            done.append(message)
+            await asyncio.sleep(args.think_time)
+
+    rss_before = current_rss_mb()
+    lag = EventLoopLagMonitor()
+    lag.start()
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    if args.trace_memory:
+        tracemalloc.stop()
+    await lag.stop()
+    rss_after = current_rss_mb()
+
+    answered = [m for m in done if not m.shed]
+    latencies = [m.channel.last_activity_at - m.created_at for m in answered if m.channel.last_activity_at]
+    first_text = [m.channel.first_text_at - m.created_at for m in answered if m.channel.first_text_at]
+    result = {
+        "users": users,
+        "messages": len(done),
+        "answered": len(answered),
+        "shed": len(done) - len(answered),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_msg_s": round(len(answered) / elapsed, 3) if elapsed else 0.0,
+        "latency_p50_s": round(percentile(latencies, 50), 4),
+        "latency_p99_s": round(percentile(latencies, 99), 4),
+        "first_text_p50_s": round(percentile(first_text, 50), 4),
+        "first_text_p99_s": round(percentile(first_text, 99), 4),
+        "loop_lag_p99_ms": round(percentile(lag.lags, 99) * 1000, 3),
+        "loop_lag_max_ms": round(max(lag.lags, default=0.0) * 1000, 3),
+        "rss_mb": rss_after,
+        "rss_growth_mb": round(rss_after - rss_before, 1) if rss_after is not None and rss_before is not None else None,
+    }
+    if peak is not None:
+        result["tracemalloc_peak_mb"] = round(peak / 1024 / 1024, 2)
+    return result
+
+async def reset_state(main, fakes, args):
+    """ ล้าง cache และ state ระหว่างแต่ละระดับ ให้ผลแต่ละระดับไม่กระทบกัน """
+    await main.context_writer.flush()
+    main.bot.pool = fakes.FakePool(latency=args.pg_latency)
+    main.response_cache = main.ResponseCache()
+    main.search_cache = main.TTLCache(main.SEARCH_CACHE_SIZE, main.SEARCH_CACHE_TTL)
+    main.summary_cache = main.TTLCache(1024, main.CONTEXT_CACHE_TTL)
+    if main.redis_instance is not None:
+        await main.redis_instance.flushall()
+
+async def run(args):
+    from bench import fakes
+
+    main = import_bot(args)
+    import openai
+
+    rng = random.Random(args.seed)
+    server = await fakes.FakeOpenAIServer(
+        latency=args.openai_latency,
+        tokens=args.openai_tokens,
+        token_interval=args.token_interval,
+        rate_429=args.rate_429,
+        seed=args.seed,
+    ).start()
+    main.openai_client = openai.AsyncOpenAI(api_key="bench", base_url=server.base_url, max_retries=0)
+
+    if not args.no_redis:
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("ต้องติดตั้ง fakeredis ก่อน: pip install 'fakeredis[lua]' (หรือใช้ --no-redis)")
+        main.redis_instance = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    # ให้ FakeMessage รู้ว่าคำตอบเสร็จแล้ว ไม่ว่าบอทจะตอบผ่าน reply หรือ stream ผ่าน channel.send
+    handler = main.reply_scheduler.handler
+
+    async def handle_and_mark_done(message, text):
+        try:
+            await handler(message, text)
+        finally:
+            message.done.set()
+
+    main.reply_scheduler.handler = handle_and_mark_done
+    main.context_writer.start()
+    main.reply_scheduler.start()
+    levels = {}
+    try:
+        for users in (int(level) for level in args.levels.split(",") if level.strip()):
+            await reset_state(main, fakes, args)
+            result = await run_level(main, fakes, args, users, rng)
+            levels[str(users)] = result
+            print(
+                f"users={users:<4} msgs={result['messages']:<5} shed={result['shed']:<4} "
+                f"thr={result['throughput_msg_s']:>7.2f}/s p50={result['latency_p50_s']:.3f}s "
+                f"p99={result['latency_p99_s']:.3f}s first_text_p50={result['first_text_p50_s']:.3f}s "
+                f"lag_p99={result['loop_lag_p99_ms']:.1f}ms rss={result['rss_mb']}MB (+{result['rss_growth_mb']})"
+            )
+    finally:
+        await main.reply_scheduler.close()
+        await main.context_writer.close()
+        await main.openai_client.close()
+        await server.close()
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("save", "compare")},
+        "openai_requests": server.requests,
+        "openai_429": server.rejected,
+        "levels": levels,
+    }
+
+def compare(report, baseline, tolerance):
+    """ เทียบผลกับ baseline คืนรายการ regression ที่เจอ """
+    regressions = []
+    checks = (
+        ("throughput_msg_s", False),
+        ("latency_p50_s", True),
+        ("latency_p99_s", True),
+        ("first_text_p99_s", True),
+    )
+    for level, result in report["levels"].items():
+        base = baseline.get("levels", {}).get(level)
+        if base is None:
+            continue
+        for key, lower_is_better in checks:
+            old, new = base.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change > tolerance) if lower_is_better else (change < -tolerance):
+                regressions.append(f"users={level} {key}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+def cli(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"บันทึก baseline ที่ {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("❌ พบ regression:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("✅ ไม่พบ regression เทียบกับ baseline")
+
+if __name__ == "__main__":
+    cli()
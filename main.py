@@ -1,5 +1,7 @@
 import os
 import json
+import html
+import re
 import logging
 import asyncpg
 import asyncio
@@ -10,14 +12,29 @@ import openai
 import time
 import httpx
 import random
-import requests
+import hashlib
+import ipaddress
+import socket
+import unicodedata
+import functools
+import contextlib
+import contextvars
+import signal
+import sys
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 
 # โหลด environment variables
 load_dotenv()
 
+# ลำดับของ worker process เมื่อรันหลาย process ผ่าน supervisor (ดู supervise)
+WORKER_ID = os.getenv("WORKER_ID")
+
 # ตั้งค่า Logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+logging.basicConfig(
+    level=logging.INFO,
+    format=f"%(asctime)s %(levelname)s{f' [worker {WORKER_ID}]' if WORKER_ID else ''}: %(message)s",
+)
 logger = logging.getLogger('discord_bot')
 
 # โหลด API Key และ Token
@@ -36,22 +53,317 @@ REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost')
 CHANNEL_ID = 1350812185001066538  # ไอดีของห้องที่ต้องการให้บอทตอบกลับ
 LOG_CHANNEL_ID = 1350924995030679644  # ไอดีของห้อง logs
 
+def parse_shard_ids(value):
+    """ แปลง "0-3,8" เป็น [0, 1, 2, 3, 8] """
+    shard_ids = []
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(shard_ids))
+
+# ตั้งค่า sharding (ทุก shard ใช้บริบท, cache และ rate limit ร่วมกันผ่าน Redis/PostgreSQL)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))  # จำนวน shard ทั้งหมด (0 = ไม่แบ่ง shard)
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS", ""))  # shard ที่ process นี้ดูแล (ว่าง = ทุก shard)
+AUTO_SHARD = os.getenv("AUTO_SHARD", "0") == "1"  # ให้ Discord กำหนดจำนวน shard เองใน process เดียว
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))  # จำนวน worker process ที่ supervisor จะเปิด
+WORKER_RESTART_MAX_DELAY = float(os.getenv("WORKER_RESTART_MAX_DELAY", "60"))  # วินาทีสูงสุดที่รอก่อนเปิด worker ที่ล่มใหม่
+WORKER_STABLE_SECONDS = float(os.getenv("WORKER_STABLE_SECONDS", "300"))  # worker ที่รันได้นานเกินนี้จะรีเซ็ต backoff
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "30"))  # วินาทีที่รอ worker ปิดตัวก่อน kill
+
+if SHARD_IDS and not SHARD_COUNT:
+    raise RuntimeError("ต้องกำหนด SHARD_COUNT เมื่อกำหนด SHARD_IDS")
+
 # ตั้งค่า Discord Bot
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="$", intents=intents)
+if SHARD_COUNT or AUTO_SHARD:
+    bot = commands.AutoShardedBot(
+        command_prefix="$",
+        intents=intents,
+        shard_count=SHARD_COUNT or None,
+        shard_ids=SHARD_IDS or None,
+    )
+else:
+    bot = commands.Bot(command_prefix="$", intents=intents)
 
 # ตั้งค่า OpenAI
 openai.api_key = OPENAI_API_KEY
 
-# ใช้ OpenAI client เวอร์ชันใหม่
-openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# ใช้ OpenAI client แบบ async เพื่อไม่ให้ event loop ค้างระหว่างรอคำตอบ
+# ปิด retry ในตัว client เพราะ create_chat_completion จัดการ retry/backoff ร่วมกับ rate limiter เอง
+openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+# พารามิเตอร์มาตรฐานของ chat completion
+CHAT_COMPLETION_PARAMS = {
+    "model": "gpt-4o-mini",
+    "max_tokens": 1500,
+    "temperature": 0.8,
+    "top_p": 1.0,
+    "frequency_penalty": 0.3,
+    "presence_penalty": 0.4,
+}
+
+# ตั้งค่าการส่งข้อความแบบ streaming
+DISCORD_MESSAGE_LIMIT = 2000  # จำนวนตัวอักษรสูงสุดต่อข้อความของ Discord
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))  # วินาทีขั้นต่ำระหว่างการ edit แต่ละครั้งในห้องเดียวกัน
+STREAM_PLACEHOLDER = "💭 พี่หลามกำลังพิมพ์..."
+STREAM_CUT_OFF_NOTE = "\n\n⚠️ *(คำตอบขาดหายระหว่างทาง)*"
+
+# ตั้งค่าการเก็บบริบทการสนทนา (ตาราง chat_messages)
+CONTEXT_WINDOW = int(os.getenv("CONTEXT_WINDOW", "40"))  # จำนวนข้อความล่าสุดที่ดึงมาเลือกใส่ prompt (ควรไม่เกิน CONTEXT_CACHE_SIZE)
+CONTEXT_RETENTION = int(os.getenv("CONTEXT_RETENTION", "200"))  # จำนวนข้อความสูงสุดที่เก็บต่อห้อง (0 = ไม่จำกัด)
+CONTEXT_MAX_AGE_DAYS = int(os.getenv("CONTEXT_MAX_AGE_DAYS", "0"))  # ลบข้อความที่เก่ากว่านี้ (0 = ไม่ลบตามอายุ)
+CONTEXT_PRUNE_INTERVAL = float(os.getenv("CONTEXT_PRUNE_INTERVAL", "600"))  # วินาทีระหว่างการ prune แต่ละรอบ
+CONTEXT_FLUSH_SIZE = int(os.getenv("CONTEXT_FLUSH_SIZE", "100"))  # flush ทันทีเมื่อมีข้อความค้างครบจำนวนนี้
+CONTEXT_FLUSH_INTERVAL = float(os.getenv("CONTEXT_FLUSH_INTERVAL", "2"))  # วินาทีสูงสุดที่ข้อความค้างอยู่ในหน่วยความจำ
+CONTEXT_BUFFER_LIMIT = int(os.getenv("CONTEXT_BUFFER_LIMIT", "10000"))  # จำนวนข้อความค้างสูงสุดเมื่อ database ล่ม
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", "50"))  # จำนวนข้อความล่าสุดต่อห้องที่ cache ใน Redis
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "21600"))  # วินาทีก่อน cache ของห้องที่เงียบจะหมดอายุ
+
+# ตั้งค่าการสรุปบทสนทนาแบบต่อเนื่อง (rolling summary)
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "20"))  # สรุปเมื่อมีข้อความใหม่ครบจำนวนนี้
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "3000"))  # หรือเมื่อข้อความใหม่รวมกันเกิน token นี้
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", str(CONTEXT_WINDOW)))  # ข้อความล่าสุดที่ยังไม่ถูกพับเข้า summary (ก่อนรู้ว่า prompt ใส่ประวัติได้กี่ข้อความ)
+SUMMARY_FAILURE_COOLDOWN = float(os.getenv("SUMMARY_FAILURE_COOLDOWN", "300"))  # วินาทีที่พักการสรุปของห้องหลังสรุปไม่สำเร็จ (เพิ่มเท่าตัวทุกครั้งที่ล้มเหลวซ้ำ)
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", "200"))  # จำนวนข้อความสูงสุดที่พับต่อหนึ่งรอบ
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+
+# เก็บ reference ของ background task ไว้ไม่ให้ถูก garbage collect
+background_tasks = set()
+
+def start_background_task(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+class TTLCache:
+    """ cache ในหน่วยความจำแบบ LRU ที่แต่ละรายการมีอายุ (TTL) """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def __len__(self):
+        return len(self._data)
+
+class SingleFlight:
+    """ รวม request ที่ซ้ำกันซึ่งเกิดพร้อมกัน ให้ทำงานจริงแค่ครั้งเดียวแล้วแชร์ผลลัพธ์ """
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, func):
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # กัน warning "exception was never retrieved" เมื่อไม่มีใครรอ
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+# เก็บสถิติเวลาในแต่ละขั้นตอนและตัวนับต่างๆ
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # port ของ Prometheus endpoint (0 = ปิด)
+if METRICS_PORT and WORKER_ID:
+    METRICS_PORT += int(WORKER_ID)  # แต่ละ worker ใช้ port ถัดกันไป
+
+class LatencyHistogram:
+    """ histogram แบบ HDR (log-linear) เก็บเวลาเป็นไมโครวินาที ความคลาดเคลื่อนไม่เกินประมาณ 6% """
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts = {}  # bucket index -> จำนวน
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, value):
+        if value < 2 * self.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - self.SUB_BUCKET_BITS - 1
+        return shift * self.SUB_BUCKETS + (value >> shift)
+
+    def _value(self, index):
+        """ ค่ากลางของ bucket """
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        mantissa = index - shift * self.SUB_BUCKETS
+        return ((mantissa << shift) + ((mantissa + 1) << shift)) / 2
+
+    def record(self, seconds):
+        micros = max(0, int(seconds * 1_000_000))
+        index = self._index(micros)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """ ค่าที่ percentile p (0-100) หน่วยวินาที """
+        if not self.count:
+            return 0.0
+        target = max(1, int(round(self.count * p / 100)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._value(index) / 1_000_000, self.max)
+        return self.max
+
+class Metrics:
+    """ registry ของ latency histogram ต่อขั้นตอน, ตัวนับ และค่าที่อ่านจาก component อื่น (gauge) """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._collectors = []
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """ จับเวลาช่วงโค้ดด้วย with metrics.timer("stage"): """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage):
+        """ decorator จับเวลาทุกครั้งที่ coroutine function ถูกเรียก """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register_collector(self, collector):
+        """ collector คือ function ที่คืน dict ของ ชื่อ -> ค่าตัวเลข ณ ตอนที่ถูกอ่าน """
+        self._collectors.append(collector)
+
+    def gauges(self):
+        values = {}
+        for collector in self._collectors:
+            try:
+                values.update(collector())
+            except Exception as e:
+                logger.warning(f'metrics collector: {e}')
+        return values
+
+    def render_prometheus(self):
+        lines = []
+        for stage, histogram in sorted(self.histograms.items()):
+            name = "bot_stage_seconds"
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {histogram.percentile(q * 100):.6f}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        if self.histograms:
+            lines.insert(0, "# TYPE bot_stage_seconds summary")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE bot_{name}_total counter")
+            lines.append(f"bot_{name}_total {value}")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE bot_{name} gauge")
+            lines.append(f"bot_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+async def handle_metrics_request(reader, writer):
+    """ HTTP server ขนาดเล็กสำหรับ Prometheus scrape (ตอบ /metrics เท่านั้น) """
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # อ่าน header ทิ้งจนจบ
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            body = metrics.render_prometheus().encode()
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        logger.debug(f'metrics request: {e}')
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        logger.info(f"📈 Prometheus metrics ที่ http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        return server
+    except OSError as e:
+        logger.error(f"❌ เปิด metrics server ไม่สำเร็จ: {e}")
+        return None
 
 # เชื่อมต่อ Redis
 redis_instance = None
 
 async def setup_redis():
     global redis_instance
+    if redis_instance is not None:
+        return
     try:
         redis_instance = await redis.from_url(REDIS_URL, decode_responses=True)
         await redis_instance.ping()
@@ -62,6 +374,8 @@ async def setup_redis():
 
 # เชื่อมต่อ PostgreSQL
 async def setup_postgres():
+    if getattr(bot, "pool", None) is not None:
+        return
     if DATABASE_URL:
         logger.info(f"🔍 DATABASE_URL: {'✅ มีค่า' if DATABASE_URL else '❌ ไม่มีค่า'}")
     else:
@@ -98,102 +412,970 @@ async def setup_postgres():
         logger.error(f"OpenAI API Error: {e}")
         return "ขออภัย ระบบมีปัญหา"
 
+# สถานะสุขภาพของ OpenAI API (circuit breaker)
+OPENAI_FAILURE_THRESHOLD = int(os.getenv("OPENAI_FAILURE_THRESHOLD", "5"))  # จำนวนครั้งที่ล้มเหลวติดกันก่อนเปิด circuit
+OPENAI_PROBE_INTERVAL = float(os.getenv("OPENAI_PROBE_INTERVAL", "30"))  # วินาทีระหว่างการ probe ตอน circuit เปิด
+
+# ความล้มเหลวล่าสุดของ OpenAI ใน task ปัจจุบัน: ประเภทจาก classify_openai_error, "circuit" ถ้า circuit ไม่ให้เรียก
+# หรือ "request" ถ้าเป็นความผิดของ request เอง (เช่น 400) ใช้ตัดสินว่าควรเก็บข้อความไว้ตอบทีหลังหรือไม่
+openai_failure = contextvars.ContextVar("openai_failure", default=None)
+
+def openai_outage_failure():
+    """ ความล้มเหลวล่าสุดใน task นี้มาจาก OpenAI ใช้งานไม่ได้ (ลองใหม่ทีหลังมีโอกาสสำเร็จ) หรือไม่ """
+    return openai_failure.get() not in (None, "request")
+
+def classify_openai_error(error):
+    """ จัดประเภทข้อผิดพลาดของ OpenAI ที่บอกสุขภาพของ API (None = ไม่เกี่ยวกับสุขภาพของ API) """
+    if isinstance(error, openai.RateLimitError):
+        return "quota" if getattr(error, "code", None) == "insufficient_quota" else "rate_limit"
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+        return "auth"
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return "server"
+    return None
+
+class OpenAIHealth:
+    """ circuit breaker (closed/open/half-open) ที่เรียนรู้จากผลของ completion จริง
+
+    ตอน closed จะไม่เรียก API เพิ่มเลย ตอน open จะ probe ด้วย models.list() เป็นระยะใน background
+    เมื่อ probe ผ่านจะเข้า half-open และปล่อย request จริงผ่านไปทีละหนึ่งเพื่อทดสอบ
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    ALERTS = {
+        "quota": "ขออภัย โควต้าการใช้งานของระบบหมด กรุณาตรวจสอบ OpenAI API",
+        "auth": "ขออภัย API Key ไม่มีสิทธิ์เข้าถึง กรุณาตรวจสอบคีย์",
+        "rate_limit": "⚠️ OpenAI API ติด rate limit ต่อเนื่อง พักการเรียกใช้ชั่วคราว",
+        "server": "⚠️ OpenAI API มีปัญหาฝั่งเซิร์ฟเวอร์ (5xx) พักการเรียกใช้ชั่วคราว",
+        "timeout": "⚠️ OpenAI API ตอบช้าจน timeout ต่อเนื่อง พักการเรียกใช้ชั่วคราว",
+        "connection": "⚠️ เชื่อมต่อ OpenAI API ไม่ได้ พักการเรียกใช้ชั่วคราว",
+    }
+
+    def __init__(self, failure_threshold=OPENAI_FAILURE_THRESHOLD, probe_interval=OPENAI_PROBE_INTERVAL):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.state = self.CLOSED
+        self.failures = 0
+        self.reason = None
+        self.opened_at = None
+        self._trial_started = None
+        self._probe_task = None
+        self._alerted = False
+
+    @property
+    def is_closed(self):
+        return self.state == self.CLOSED
+
+    def can_request(self):
+        """ ตรวจว่าตอนนี้ request จะได้ผ่านหรือไม่ โดยไม่จองสิทธิ์ทดสอบของ half-open """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN:
+            return self._trial_started is None or time.monotonic() - self._trial_started > self.probe_interval
+        return False
+
+    def allow_request(self):
+        """ ตรวจว่าควรส่ง request ไปที่ OpenAI หรือไม่ (ตอน half-open ปล่อยผ่านทีละหนึ่ง) """
+        if not self.can_request():
+            return False
+        if self.state == self.HALF_OPEN:
+            self._trial_started = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._trial_started = None
+        if self.state != self.CLOSED:
+            logger.info("✅ OpenAI API กลับมาใช้งานได้แล้ว ปิด circuit")
+            self.state = self.CLOSED
+            reply_retry_queue.wakeup()
+            self.reason = None
+            self.opened_at = None
+            if self._alerted:
+                self._alerted = False
+                self._notify("✅ OpenAI API กลับมาใช้งานได้ตามปกติแล้ว")
+
+    def record_failure(self, kind):
+        openai_failure.set(kind or "request")
+        if kind is None:
+            # ข้อผิดพลาดฝั่ง request (เช่น 400) แปลว่า API ยังตอบได้ปกติ
+            self.record_success()
+            return
+        self._trial_started = None
+        self.failures += 1
+        if self.state == self.OPEN:
+            return
+        if kind in ("quota", "auth") or self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._trip(kind)
+
+    def _trip(self, kind):
+        self.state = self.OPEN
+        self.reason = kind
+        self.opened_at = time.monotonic()
+        logger.error(f"❌ เปิด circuit ของ OpenAI API เพราะ {kind} (ล้มเหลว {self.failures} ครั้ง)")
+        # แจ้งเตือนครั้งเดียวต่อการล่มหนึ่งครั้ง ไม่ใช่ทุกข้อความ
+        if not self._alerted:
+            self._alerted = True
+            self._notify(self.ALERTS.get(kind, f"⚠️ OpenAI API มีปัญหา: {kind}"))
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = start_background_task(self._probe_loop())
+
+    async def _probe_loop(self):
+        """ probe API เป็นระยะเฉพาะตอน circuit เปิด เมื่อผ่านจะเข้า half-open """
+        while self.state == self.OPEN:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await openai_client.models.list()
+            except openai.OpenAIError as e:
+                logger.warning(f"OpenAI API ยังไม่พร้อม ({classify_openai_error(e)}): {e}")
+                continue
+            logger.info("OpenAI API ตอบ probe แล้ว เข้าสู่ half-open")
+            self.state = self.HALF_OPEN
+            self._trial_started = None
+
+    def _notify(self, text):
+        try:
+            start_background_task(send_message_to_channel(LOG_CHANNEL_ID, text))
+        except RuntimeError:
+            logger.warning(f"ส่งแจ้งเตือนไม่ได้เพราะไม่มี event loop: {text}")
+
+openai_health = OpenAIHealth()
+
+@metrics.timed("openai_health")
 async def check_openai_quota_and_handle_errors():
-    """ ตรวจสอบโควต้าการใช้งาน OpenAI API และจัดการกับข้อผิดพลาด """
-    try:
-        response = openai_client.models.list()
-        logger.info("OpenAI API พร้อมใช้งาน")
+    """ ตรวจสอบสถานะ OpenAI API จาก circuit breaker ที่ cache ไว้ (ไม่เรียก API เพิ่ม) """
+    if openai_health.allow_request():
         return True
-    except httpx.HTTPStatusError as e:
-        if e.response.status_code == 429:
-            logger.error("โควต้าของ OpenAI หมดแล้ว กรุณาตรวจสอบแผนการใช้งานของคุณ")
-            await send_message_to_channel(LOG_CHANNEL_ID, "ขออภัย โควต้าการใช้งานของระบบหมด กรุณาตรวจสอบ OpenAI API")
-        elif e.response.status_code == 403:
-            logger.error("API Key ไม่มีสิทธิ์เข้าถึง กรุณาตรวจสอบคีย์")
-            await send_message_to_channel(LOG_CHANNEL_ID, "ขออภัย API Key ไม่มีสิทธิ์เข้าถึง กรุณาตรวจสอบคีย์")
-        else:
-            logger.error(f"เกิดข้อผิดพลาดในการเชื่อมต่อ OpenAI API: {e}")
-        return False
+    openai_failure.set("circuit")
+    logger.warning(f"OpenAI API ยังไม่พร้อมใช้งาน (circuit {openai_health.state}: {openai_health.reason})")
+    return False
+
+# Rate limiter ของ OpenAI (RPM/TPM) ที่แชร์งบระหว่างหลาย process ผ่าน Redis
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))  # requests per minute ของบัญชี
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))  # tokens per minute ของบัญชี
+OPENAI_RATE_HEADROOM = float(os.getenv("OPENAI_RATE_HEADROOM", "0.9"))  # ใช้งบแค่สัดส่วนนี้ของ limit จริง
+OPENAI_BACKOFF_CAP = float(os.getenv("OPENAI_BACKOFF_CAP", "30"))  # วินาทีสูงสุดของ backoff
+
+# token bucket สองใบ (request และ token) ตรวจและตัดพร้อมกันแบบ atomic
+# คืนค่า 0 ถ้าได้สิทธิ์ ไม่งั้นคืนจำนวน ms ที่ควรรอ ใช้เวลาของ Redis เพื่อให้ทุก process ใช้นาฬิกาเดียวกัน
+TOKEN_BUCKET_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local cooldown = redis.call('PTTL', KEYS[3])
+if cooldown > 0 then
+    return cooldown
+end
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local cost = math.min(tonumber(ARGV[3]), tpm)
+local function level(key, capacity)
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    return math.min(capacity, tokens + math.max(0, now - ts) * capacity / 60000)
+end
+local requests = level(KEYS[1], rpm)
+local tokens = level(KEYS[2], tpm)
+local wait = 0
+if requests < 1 then
+    wait = math.max(wait, (1 - requests) * 60000 / rpm)
+end
+if tokens < cost then
+    wait = math.max(wait, (cost - tokens) * 60000 / tpm)
+end
+if wait > 0 then
+    return math.ceil(wait)
+end
+redis.call('HSET', KEYS[1], 'tokens', requests - 1, 'ts', now)
+redis.call('HSET', KEYS[2], 'tokens', tokens - cost, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], 120000)
+redis.call('PEXPIRE', KEYS[2], 120000)
+return 0
+"""
+
+class OpenAIRateLimiter:
+    """ จำกัด RPM/TPM ก่อนส่ง request (ไม่ต้องรอโดน 429 ก่อน)
 
-async def get_openai_response(messages, max_retries=3, delay=5):
-    """ ดึงข้อมูลจาก OpenAI API พร้อม retry หากเจอข้อผิดพลาด 429 """
+    ถ้ามี Redis จะใช้ token bucket ใน Redis (Lua script) ให้ทุก instance ของบอทใช้งบเดียวกัน
+    ถ้าไม่มีหรือ Redis ใช้ไม่ได้จะใช้ bucket ใน process แทน
+    """
+
+    KEY_PREFIX = "ratelimit:openai"
+
+    def __init__(self, rpm=OPENAI_RPM_LIMIT, tpm=OPENAI_TPM_LIMIT, headroom=OPENAI_RATE_HEADROOM):
+        self.rpm = max(1, int(rpm * headroom))
+        self.tpm = max(1, int(tpm * headroom))
+        self._script = None
+        self._script_client = None
+        self._redis_failed = False
+        now = time.monotonic()
+        self._local = {"requests": float(self.rpm), "tokens": float(self.tpm), "ts": now}
+        self._local_cooldown_until = 0.0
+        self.waited = 0.0  # เวลารอสะสม (วินาที)
+
+    async def acquire(self, tokens):
+        """ รอจนกว่าจะมีงบพอสำหรับ request หนึ่งครั้งที่ใช้ token ประมาณ tokens """
+        started = time.monotonic()
+        while True:
+            wait_ms = await self._reserve(tokens)
+            if wait_ms <= 0:
+                waited = time.monotonic() - started
+                self.waited += waited
+                metrics.observe("ratelimit_wait", waited)
+                return
+            # ใส่ jitter กันทุก coroutine ตื่นขึ้นมาแย่งกันพร้อมกัน
+            await asyncio.sleep(wait_ms / 1000 + random.uniform(0, 0.05))
+
+    async def pause(self, seconds):
+        """ หยุดส่ง request ทั้งหมด (ทุก instance) ชั่วคราวหลังโดน 429 """
+        self._local_cooldown_until = max(self._local_cooldown_until, time.monotonic() + seconds)
+        if redis_instance is not None:
+            try:
+                await redis_instance.set(f"{self.KEY_PREFIX}:cooldown", "1", px=max(1, int(seconds * 1000)))
+            except Exception as e:
+                logger.warning(f'OpenAIRateLimiter.pause: {e}')
+
+    async def _reserve(self, tokens):
+        if redis_instance is not None:
+            try:
+                if self._script is None or self._script_client is not redis_instance:
+                    self._script = redis_instance.register_script(TOKEN_BUCKET_LUA)
+                    self._script_client = redis_instance
+                wait_ms = await self._script(
+                    keys=[f"{self.KEY_PREFIX}:rpm", f"{self.KEY_PREFIX}:tpm", f"{self.KEY_PREFIX}:cooldown"],
+                    args=[self.rpm, self.tpm, int(tokens)],
+                )
+                self._redis_failed = False
+                return int(wait_ms)
+            except Exception as e:
+                if not self._redis_failed:
+                    logger.warning(f"⚠️ ใช้ rate limiter ใน Redis ไม่ได้ เปลี่ยนไปใช้ใน process แทน: {e}")
+                    self._redis_failed = True
+        return self._reserve_local(tokens)
+
+    def _reserve_local(self, tokens):
+        now = time.monotonic()
+        if now < self._local_cooldown_until:
+            return (self._local_cooldown_until - now) * 1000
+        state = self._local
+        elapsed = now - state["ts"]
+        requests = min(self.rpm, state["requests"] + elapsed * self.rpm / 60)
+        available = min(self.tpm, state["tokens"] + elapsed * self.tpm / 60)
+        cost = min(tokens, self.tpm)
+        wait = 0.0
+        if requests < 1:
+            wait = max(wait, (1 - requests) * 60 / self.rpm)
+        if available < cost:
+            wait = max(wait, (cost - available) * 60 / self.tpm)
+        if wait > 0:
+            return wait * 1000
+        self._local = {"requests": requests - 1, "tokens": available - cost, "ts": now}
+        return 0
+
+openai_rate_limiter = OpenAIRateLimiter()
+
+# นับ token ด้วย tokenizer ในเครื่อง
+MESSAGE_TOKEN_OVERHEAD = 4  # token ที่ใช้กำกับ role/ขอบเขตของแต่ละข้อความ
+REPLY_PRIMING_TOKENS = 3    # token ที่ใช้เริ่มคำตอบของ assistant
+
+@functools.lru_cache(maxsize=1)
+def get_encoding():
+    # import ตอนใช้ครั้งแรก (โหลด tokenizer ใช้เวลา ไม่ควรอยู่ใน path ของการ start บอท)
+    try:
+        import tiktoken
+    except ImportError:
+        return None  # ไม่มี tokenizer จะประมาณจำนวน token จากความยาวข้อความแทน
+    try:
+        return tiktoken.encoding_for_model(CHAT_COMPLETION_PARAMS["model"])
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"⚠️ โหลด tokenizer ไม่สำเร็จ จะประมาณจำนวน token แทน: {e}")
+        return None
+
+@functools.lru_cache(maxsize=8192)
+def count_tokens(text):
+    """ นับ token ของข้อความ (cache ผลไว้ ข้อความในบริบทเดิมจะไม่ถูกนับซ้ำทุกครั้ง) """
+    encoding = get_encoding()
+    if encoding is None:
+        # ภาษาไทยประมาณ 1 token ต่อ 2 ตัวอักษร
+        return len(text) // 2 + 1
+    return len(encoding.encode(text))
+
+def count_message_tokens(message):
+    return count_tokens(message.get("content") or "") + MESSAGE_TOKEN_OVERHEAD
+
+def estimate_tokens(messages):
+    """ จำนวน token ของ prompt ทั้งชุด """
+    return sum(count_message_tokens(message) for message in messages) + REPLY_PRIMING_TOKENS
+
+def retry_after_seconds(error):
+    """ อ่านเวลาที่ OpenAI บอกให้รอจาก header retry-after-ms / retry-after """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for header, scale in (("retry-after-ms", 1000), ("retry-after", 1)):
+        value = headers.get(header)
+        if value:
+            try:
+                return float(value) / scale
+            except ValueError:
+                continue
+    return None
+
+def backoff_delay(attempt, retry_after=None, base=1.0, cap=OPENAI_BACKOFF_CAP):
+    """ exponential backoff แบบมี jitter ไม่ต่ำกว่าที่ Retry-After กำหนด """
+    delay = min(cap, base * (2 ** attempt))
+    delay = random.uniform(delay / 2, delay)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+async def create_chat_completion(messages, stream=False, max_retries=3, delay=1, **overrides):
+    """ เรียก chat completion แบบ async พร้อม rate limit และ retry หากเจอข้อผิดพลาด 429 (คืนค่า None ถ้าไม่สำเร็จ) """
     if not await check_openai_quota_and_handle_errors():
         return None
 
+    params = {**CHAT_COMPLETION_PARAMS, **overrides}
+    if stream:
+        # ให้ chunk สุดท้ายของ stream ส่งจำนวน token ที่ใช้จริงกลับมาด้วย
+        params.setdefault("stream_options", {"include_usage": True})
+    # OpenAI นับ max_tokens เข้า TPM ตั้งแต่ตอนรับ request จึงจองเผื่อไว้ด้วย
+    cost = estimate_tokens(messages) + params.get("max_tokens", 0)
     for attempt in range(max_retries):
+        await openai_rate_limiter.acquire(cost)
         try:
-            response = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                max_tokens=1500,
-                temperature=0.8,
-                top_p=1.0,
-                frequency_penalty=0.3,
-                presence_penalty=0.4
-            )
-            if not response or not response.choices:
-                logger.error("OpenAI API ตอบกลับมาเป็นค่าว่าง")
-                return "ขออภัย ระบบไม่สามารถให้คำตอบได้ในขณะนี้"
-            return response.choices[0].message.content.strip()
-        except httpx.HTTPStatusError as e:
-            if e.response.status_code == 429:
-                wait_time = delay * (attempt + 1)
-                logger.warning(f'เจอข้อผิดพลาด 429 Too Many Requests, กำลังรอ {wait_time} วินาทีแล้วลองใหม่...')
-                await asyncio.sleep(wait_time)
-            else:
-                await check_openai_quota_and_handle_errors()
+            with metrics.timer("openai_request"):
+                response = await openai_client.chat.completions.create(messages=messages, stream=stream, **params)
+            openai_health.record_success()
+            return response
+        except openai.RateLimitError as e:
+            metrics.incr("openai_429")
+            kind = classify_openai_error(e)
+            openai_health.record_failure(kind)
+            if not openai_health.is_closed or attempt == max_retries - 1:
                 break
+            wait_time = backoff_delay(attempt, retry_after_seconds(e), base=delay)
+            if kind == "rate_limit":
+                await openai_rate_limiter.pause(wait_time)
+            logger.warning(f'เจอข้อผิดพลาด 429 Too Many Requests, กำลังรอ {wait_time:.1f} วินาทีแล้วลองใหม่...')
+            metrics.incr("openai_retries")
+            await asyncio.sleep(wait_time)
+        except openai.APIStatusError as e:
+            logger.error(f"OpenAI API ตอบกลับด้วย status {e.status_code}: {e}")
+            openai_health.record_failure(classify_openai_error(e))
+            break
+        except openai.APIConnectionError as e:
+            logger.error(f"เกิดข้อผิดพลาดในการเชื่อมต่อ OpenAI API: {e}")
+            openai_health.record_failure(classify_openai_error(e))
+            break
     logger.error("เกินจำนวน retry ที่กำหนดสำหรับ OpenAI API")
     return None
 
+def record_token_usage(usage):
+    """ นับจำนวน token ที่ใช้จริงจาก usage ที่ OpenAI ส่งกลับมา """
+    if usage is not None:
+        metrics.incr("tokens_prompt", usage.prompt_tokens or 0)
+        metrics.incr("tokens_completion", usage.completion_tokens or 0)
+
+async def get_openai_response(messages, max_retries=3, delay=1, **overrides):
+    """ ดึงคำตอบเต็มจาก OpenAI API (ไม่ stream) """
+    response = await create_chat_completion(messages, max_retries=max_retries, delay=delay, **overrides)
+    if response is None:
+        return None
+    record_token_usage(getattr(response, "usage", None))
+    if not response.choices:
+        logger.error("OpenAI API ตอบกลับมาเป็นค่าว่าง")
+        return "ขออภัย ระบบไม่สามารถให้คำตอบได้ในขณะนี้"
+    return (response.choices[0].message.content or "").strip()
+
+# เวลา edit ล่าสุดของแต่ละห้อง ทุก stream ในห้องเดียวกันใช้โควต้า edit ร่วมกัน
+stream_last_edit = {}
+
+class StreamingReply:
+    """ แสดงคำตอบที่ stream มาใน Discord โดยโพสต์ข้อความชั่วคราวแล้วทยอย edit
+
+    `send` คือ coroutine function ที่ส่งข้อความใหม่แล้วคืน discord.Message
+    (เช่น channel.send หรือ interaction.followup.send แบบ wait=True)
+    การ edit ถูกจำกัดความถี่ตาม STREAM_EDIT_INTERVAL ต่อห้อง (`channel_id`) และเมื่อเนื้อหายาวเกิน
+    2000 ตัวอักษรจะตัดที่ช่องว่างสุดท้ายแล้วขึ้นข้อความใหม่ต่อเหมือน send_long_message
+    """
+
+    def __init__(self, send, placeholder=STREAM_PLACEHOLDER, edit_interval=STREAM_EDIT_INTERVAL, channel_id=None):
+        self._send = send
+        self._placeholder = placeholder
+        self._edit_interval = edit_interval
+        self._throttle_key = channel_id if channel_id is not None else id(self)
+        self._message = None  # ข้อความ Discord ที่กำลัง edit อยู่
+        self._shown = ""      # เนื้อหาที่แสดงอยู่ใน Discord ตอนนี้
+        self._current = ""    # เนื้อหาของข้อความปัจจุบัน (อาจยังไม่ได้ edit)
+        self._parts = []      # เนื้อหาของข้อความก่อนหน้าที่เต็มแล้ว
+
+    async def start(self):
+        """ โพสต์ข้อความชั่วคราวทันที ผู้ใช้จะเห็นว่าบอทกำลังตอบ """
+        with metrics.timer("discord_send"):
+            self._message = await self._send(self._placeholder)
+        self._shown = self._placeholder
+
+    async def _edit(self, content):
+        # ส่วนที่เกิน 2000 ตัวอักษรที่ยังค้างอยู่เป็นช่องว่างล้วน (รอข้อความจริงก่อนขึ้นข้อความใหม่)
+        content = content[:DISCORD_MESSAGE_LIMIT]
+        # Discord ไม่รับข้อความที่มีแต่ช่องว่าง
+        if content.strip() and content != self._shown:
+            with metrics.timer("discord_edit"):
+                await self._message.edit(content=content)
+            self._shown = content
+            stream_last_edit[self._throttle_key] = time.monotonic()
+
+    def _split_point(self):
+        """ ตำแหน่งที่จะตัดข้อความปัจจุบัน (ช่องว่างสุดท้ายภายใน 2000 ตัวอักษร) หรือ None ถ้ายังไม่ควรตัด """
+        if len(self._current) <= DISCORD_MESSAGE_LIMIT:
+            return None
+        cut = max(self._current.rfind("\n", 0, DISCORD_MESSAGE_LIMIT), self._current.rfind(" ", 0, DISCORD_MESSAGE_LIMIT))
+        if cut <= 0:
+            cut = DISCORD_MESSAGE_LIMIT
+        # ส่วนที่ล้นมาเป็นช่องว่างล้วน ส่งเป็นข้อความใหม่ไม่ได้ รอให้มีตัวอักษรจริงก่อน
+        if not self._current[cut:cut + DISCORD_MESSAGE_LIMIT].strip():
+            return None
+        return cut
+
+    async def feed(self, delta):
+        """ เพิ่มข้อความที่ได้รับจาก stream และ edit เมื่อครบช่วงเวลาที่กำหนด """
+        if not delta:
+            return
+        self._current += delta
+        cut = self._split_point()
+        while cut is not None:
+            head, self._current = self._current[:cut], self._current[cut:]
+            await self._edit(head)
+            self._parts.append(head)
+            chunk = self._current[:DISCORD_MESSAGE_LIMIT]
+            with metrics.timer("discord_send"):
+                self._message = await self._send(chunk)
+            self._shown = chunk
+            stream_last_edit[self._throttle_key] = time.monotonic()
+            cut = self._split_point()
+        if time.monotonic() - stream_last_edit.get(self._throttle_key, 0.0) >= self._edit_interval:
+            await self._edit(self._current)
+
+    @property
+    def content(self):
+        return "".join(self._parts) + self._current
+
+    async def finish(self):
+        """ edit ข้อความสุดท้ายให้ครบแล้วคืนเนื้อหาทั้งหมด """
+        await self._edit(self._current)
+        return self.content.strip()
+
+    async def cut_off(self):
+        """ ปิดท้ายข้อความที่แสดงไปแล้วบางส่วนด้วยหมายเหตุว่าคำตอบขาดหาย (เมื่อ stream ขาดระหว่างทาง) """
+        if self._message is None:
+            return
+        try:
+            await self.feed(STREAM_CUT_OFF_NOTE)
+            await self._edit(self._current)
+        except discord.HTTPException as e:
+            logger.error(f'แก้ข้อความที่ขาดหายไม่สำเร็จ: {e}')
+
+    async def abort(self):
+        """ ลบข้อความชั่วคราวในกรณีที่ไม่ได้รับเนื้อหาใดๆ เลย """
+        if self._message is not None and not self.content:
+            try:
+                await self._message.delete()
+            except discord.HTTPException as e:
+                logger.error(f'ลบข้อความชั่วคราวไม่สำเร็จ: {e}')
+        self._message = None
+
+async def stream_openai_response(send, messages, header="", channel_id=None, **overrides):
+    """ สตรีมคำตอบจาก OpenAI ลง Discord แบบ progressive และคืนข้อความเต็ม (None ถ้าไม่สำเร็จ)
+
+    `header` จะขึ้นนำหน้าคำตอบใน Discord เมื่อได้ token แรก แต่ไม่รวมอยู่ในข้อความที่คืนกลับ
+    `channel_id` ใช้จำกัดความถี่การ edit ร่วมกับ stream อื่นในห้องเดียวกัน
+    """
+    # circuit เปิดอยู่ไม่ต้องโพสต์ข้อความชั่วคราวแล้วลบทิ้ง
+    if not openai_health.can_request():
+        openai_failure.set("circuit")
+        logger.warning(f"OpenAI API ยังไม่พร้อมใช้งาน (circuit {openai_health.state}: {openai_health.reason})")
+        return None
+    started = time.perf_counter()
+    reply = StreamingReply(send, channel_id=channel_id)
+    # โพสต์ข้อความชั่วคราวพร้อมกับเปิด stream ไม่ต้องรอกัน
+    # เรียก OpenAI ใน task นี้เอง เพื่อให้ openai_failure ที่ตั้งระหว่างเรียกมองเห็นได้จากผู้เรียก
+    placeholder = asyncio.ensure_future(reply.start())
+    try:
+        stream = await create_chat_completion(messages, stream=True, **overrides)
+    except BaseException:
+        await placeholder
+        raise
+    try:
+        await placeholder
+    except BaseException:
+        if stream is not None:
+            await stream.close()
+        raise
+    if stream is None:
+        await reply.abort()
+        return None
+
+    first_token = True
+    try:
+        async for chunk in stream:
+            record_token_usage(getattr(chunk, "usage", None))
+            if chunk.choices:
+                if first_token and chunk.choices[0].delta.content:
+                    first_token = False
+                    metrics.observe("openai_first_token", time.perf_counter() - started)
+                    await reply.feed(header)
+                await reply.feed(chunk.choices[0].delta.content)
+    except openai.OpenAIError as e:
+        # คำตอบที่ขาดกลางทางไม่นับว่าสำเร็จ ห้ามเก็บลง cache หรือบริบทของห้อง
+        logger.error(f"OpenAI stream ขาดระหว่างทาง: {e}")
+        openai_health.record_failure(classify_openai_error(e))
+        if reply.content[len(header):].strip():
+            await reply.cut_off()
+        else:
+            await reply.abort()
+        return None
+    finally:
+        # ปิด connection ของ stream เสมอ แม้ Discord จะ error ระหว่าง edit
+        await stream.close()
+
+    if not reply.content[len(header):].strip():
+        logger.error("OpenAI API ตอบกลับมาเป็นค่าว่าง")
+        await reply.abort()
+        return None
+    content = await reply.finish()
+    metrics.observe("openai_stream", time.perf_counter() - started)
+    return content[len(header):].strip()
+
 # ค้นหาข้อมูลจาก Google
-def search_google(query):
+GOOGLE_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+SEARCH_RESULT_LIMIT = 3  # เอาแค่ 3 อันดับแรก
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))  # วินาทีที่เก็บผลการค้นหาไว้
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))  # จำนวน query สูงสุดใน cache ของแต่ละ process
+
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+search_flight = SingleFlight()
+search_http = None
+
+def get_search_http():
+    """ httpx client ที่ใช้ร่วมกัน เพื่อ reuse connection (TLS) ไปยัง Google """
+    global search_http
+    if search_http is None or search_http.is_closed:
+        search_http = httpx.AsyncClient(
+            timeout=5,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return search_http
+
+def normalize_query(query):
+    return " ".join(query.casefold().split())
+
+async def fetch_google_items(query):
+    """ เรียก Google Custom Search API จริง (ไม่ผ่าน cache) """
+    response = await get_search_http().get(
+        GOOGLE_SEARCH_URL, params={"q": query, "key": GOOGLE_API_KEY, "cx": GOOGLE_CSE_ID}
+    )
+    response.raise_for_status()
+    return [
+        {
+            "title": result.get("title", "ไม่มีชื่อ"),
+            "snippet": result.get("snippet", "ไม่มีข้อมูลสรุป"),
+            "link": result.get("link", "#"),
+        }
+        for result in response.json().get("items", [])[:SEARCH_RESULT_LIMIT]
+    ]
+
+@metrics.timed("search")
+async def search_google_items(query):
+    """ ค้นหาผ่าน cache ในหน่วยความจำ -> Redis -> Google โดย query เดียวกันที่มาพร้อมกันจะยิงแค่ครั้งเดียว """
+    normalized = normalize_query(query)
+    if not normalized:
+        return []
+    items = search_cache.get(normalized)
+    if items is not None:
+        metrics.incr("search_cache_hit")
+        return items
+    return await search_flight.do(normalized, lambda: _search_google_uncached(normalized))
+
+async def _search_google_uncached(normalized):
+    redis_key = f"search:{hashlib.sha1(normalized.encode()).hexdigest()}"
+    if redis_instance is not None:
+        try:
+            data = await redis_instance.get(redis_key)
+            if data:
+                items = json.loads(data)
+                search_cache.set(normalized, items)
+                metrics.incr("search_cache_redis_hit")
+                return items
+        except Exception as e:
+            logger.warning(f'search cache (Redis): {e}')
+
+    metrics.incr("search_upstream")
     try:
-        url = f"https://www.googleapis.com/customsearch/v1?q={query}&key={GOOGLE_API_KEY}&cx={GOOGLE_CSE_ID}"
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        results = response.json().get("items", [])
-        if results:
-            summaries = []
-            for result in results[:3]:  # เอาแค่ 3 อันดับแรก
-                title = result.get("title", "ไม่มีชื่อ")
-                snippet = result.get("snippet", "ไม่มีข้อมูลสรุป")
-                link = result.get("link", "#")
-                summaries.append(f"🔹 **{title}**\n{snippet}\n🔗 {link}")
-            return "\n\n".join(summaries)
-    except requests.exceptions.RequestException as e:
+        items = await fetch_google_items(normalized)
+    except httpx.HTTPError as e:
         logger.error(f"เกิดข้อผิดพลาดใน Google Search API: {e}")
-    return "ไม่พบข้อมูลจาก Google"
+        return []
+
+    search_cache.set(normalized, items)
+    if redis_instance is not None:
+        try:
+            await redis_instance.set(redis_key, json.dumps(items, ensure_ascii=False), ex=SEARCH_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f'search cache (Redis): {e}')
+    return items
+
+def format_search_results(items):
+    return "\n\n".join(f"🔹 **{item['title']}**\n{item['snippet']}\n🔗 {item['link']}" for item in items)
+
+# ตั้งค่าการสรุปผลการค้นหา
+SEARCH_FETCH_PAGES = os.getenv("SEARCH_FETCH_PAGES", "0") == "1"  # ดึงเนื้อหาหน้าเว็บของผลลัพธ์มาช่วยสรุปด้วย
+SEARCH_FETCH_CONCURRENCY = int(os.getenv("SEARCH_FETCH_CONCURRENCY", "3"))  # จำนวนหน้าเว็บที่ดึงพร้อมกันได้สูงสุด
+SEARCH_PAGE_TIMEOUT = float(os.getenv("SEARCH_PAGE_TIMEOUT", "3"))  # วินาทีสูงสุดที่รอแต่ละหน้าเว็บ
+SEARCH_PAGE_CHARS = int(os.getenv("SEARCH_PAGE_CHARS", "1500"))  # จำนวนตัวอักษรที่ใช้จากแต่ละหน้า
+SEARCH_PAGE_MAX_BYTES = int(os.getenv("SEARCH_PAGE_MAX_BYTES", "200000"))  # ไบต์สูงสุดที่อ่านจากแต่ละหน้า
+SEARCH_PAGE_MAX_REDIRECTS = 3  # จำนวน redirect สูงสุดที่ตามไป (ตรวจ address ทุกทอด)
+SEARCH_SUMMARY_HEADER = "📝 **สรุปข้อมูลโดย AI:**\n"
+SEARCH_SUMMARY_FAILED = "❌ ขอโทษด้วย พี่หลามสรุปไม่ได้ตอนนี้"
+
+search_summary_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+search_page_semaphore = asyncio.Semaphore(SEARCH_FETCH_CONCURRENCY)
+
+HTML_HIDDEN_RE = re.compile(r"<(script|style|noscript|head)\b.*?</\1\s*>", re.S | re.I)
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+WHITESPACE_RE = re.compile(r"\s+")
+
+def html_to_text(source):
+    """ แปลง HTML เป็นข้อความล้วนแบบคร่าวๆ (พอสำหรับส่งให้โมเดลสรุป) """
+    source = HTML_HIDDEN_RE.sub(" ", source)
+    return WHITESPACE_RE.sub(" ", html.unescape(HTML_TAG_RE.sub(" ", source))).strip()
+
+async def is_public_url(url):
+    """ url เป็น http/https ที่ทุก address ของ host เป็น address สาธารณะ
+
+    กันไม่ให้หน้าผลการค้นหา (หรือ redirect ของมัน) พาไปดึง loopback, private หรือ link-local
+    เช่น metrics ของบอทเอง หน้า admin ภายใน หรือ metadata service ของ cloud แล้วเอาไปสรุปลงห้องสาธารณะ
+    """
+    if url.scheme not in ("http", "https") or not url.host:
+        return False
+    port = url.port or (443 if url.scheme == "https" else 80)
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(url.host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        return False
+    try:
+        return bool(infos) and all(ipaddress.ip_address(info[4][0].split("%")[0]).is_global for info in infos)
+    except ValueError:
+        return False
+
+async def fetch_page_text(url):
+    """ ดึงเนื้อหาของหน้าเว็บ (คืน "" ถ้าดึงไม่ได้ ไม่ใช่ HTML หรือไม่ใช่ address สาธารณะ)
+
+    อ่านแบบ stream: ดู content-type จาก header ก่อนอ่าน body และหยุดอ่านเมื่อครบ SEARCH_PAGE_MAX_BYTES
+    redirect ตามเองทีละทอดเพื่อตรวจ address ด้วย is_public_url ทุกครั้ง
+    """
+    target = httpx.URL(url)
+    body, encoding = None, "utf-8"
+    async with search_page_semaphore:
+        try:
+            with metrics.timer("search_page_fetch"):
+                async with asyncio.timeout(SEARCH_PAGE_TIMEOUT):
+                    for _ in range(SEARCH_PAGE_MAX_REDIRECTS + 1):
+                        if not await is_public_url(target):
+                            logger.warning(f'ไม่ดึงหน้าเว็บ {target}: ไม่ใช่ address สาธารณะ')
+                            return ""
+                        async with get_search_http().stream(
+                            "GET", target, timeout=SEARCH_PAGE_TIMEOUT, follow_redirects=False
+                        ) as response:
+                            if response.is_redirect:
+                                target = response.url.join(response.headers.get("location", ""))
+                                continue
+                            response.raise_for_status()
+                            if "html" not in response.headers.get("content-type", ""):
+                                return ""
+                            body = bytearray()
+                            async for chunk in response.aiter_bytes():
+                                body += chunk
+                                if len(body) >= SEARCH_PAGE_MAX_BYTES:
+                                    break
+                            encoding = response.charset_encoding or "utf-8"
+                            break
+        except (httpx.HTTPError, TimeoutError) as e:
+            logger.warning(f'ดึงหน้าเว็บ {url} ไม่สำเร็จ: {e!r}')
+            return ""
+    if body is None:
+        logger.warning(f'ดึงหน้าเว็บ {url} ไม่สำเร็จ: redirect เกิน {SEARCH_PAGE_MAX_REDIRECTS} ครั้ง')
+        return ""
+    try:
+        source = bytes(body[:SEARCH_PAGE_MAX_BYTES]).decode(encoding, errors="replace")
+    except LookupError:
+        source = bytes(body[:SEARCH_PAGE_MAX_BYTES]).decode("utf-8", errors="replace")
+    return html_to_text(source)[:SEARCH_PAGE_CHARS]
+
+async def build_search_summary_input(items):
+    """ รวม snippet ของผลลัพธ์ (และเนื้อหาหน้าเว็บถ้าเปิดไว้ ดึงพร้อมกัน) เป็นข้อความให้โมเดลสรุป """
+    if SEARCH_FETCH_PAGES:
+        pages = await asyncio.gather(*(fetch_page_text(item["link"]) for item in items))
+    else:
+        pages = [""] * len(items)
+    blocks = []
+    for item, page in zip(items, pages):
+        block = f"{item['title']}\n{item['snippet']}"
+        if page:
+            block += f"\nเนื้อหา: {page}"
+        blocks.append(block)
+    return "\n\n".join(blocks)
+
+def search_results_key(items):
+    """ key ของชุดผลลัพธ์ query ต่างกันที่ได้ผลชุดเดียวกันจะใช้สรุปเดียวกัน """
+    payload = json.dumps([[item["link"], item["snippet"]] for item in items], ensure_ascii=False)
+    return f"search_summary:{hashlib.sha1(payload.encode()).hexdigest()}"
+
+async def get_cached_search_summary(key):
+    summary = search_summary_cache.get(key)
+    if summary is None and redis_instance is not None:
+        try:
+            summary = await redis_instance.get(key)
+            if summary:
+                search_summary_cache.set(key, summary)
+        except Exception as e:
+            logger.warning(f'search summary cache (Redis): {e}')
+    return summary
+
+async def set_cached_search_summary(key, summary):
+    search_summary_cache.set(key, summary)
+    if redis_instance is not None:
+        try:
+            await redis_instance.set(key, summary, ex=SEARCH_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f'search summary cache (Redis): {e}')
+
+async def stream_search_summary(items, send, channel_id=None):
+    """ สรุปผลการค้นหาแล้ว stream ลง Discord ผ่าน send (ใช้สรุปเดิมถ้าเคยสรุปผลชุดนี้แล้ว) """
+    key = search_results_key(items)
+    summary = await get_cached_search_summary(key)
+    if summary:
+        metrics.incr("search_summary_cache_hit")
+        content = SEARCH_SUMMARY_HEADER + summary
+        for i in range(0, len(content), DISCORD_MESSAGE_LIMIT):
+            await send(content[i:i + DISCORD_MESSAGE_LIMIT])
+        return summary
+
+    messages = [
+        {"role": "system", "content": "สรุปข้อความภาษาไทยให้กระชับ และเข้าใจง่าย โดยใช้ภาษาพูดธรรมชาติ"},
+        {"role": "user", "content": f"สรุปเนื้อหานี้ให้หน่อย:\n{await build_search_summary_input(items)}"},
+    ]
+    with metrics.timer("search_summary"):
+        summary = await stream_openai_response(
+            send,
+            messages,
+            header=SEARCH_SUMMARY_HEADER,
+            channel_id=channel_id,
+            max_tokens=800,
+            temperature=0.7,
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+        )
+    if summary:
+        await set_cached_search_summary(key, summary)
+    else:
+        await send(SEARCH_SUMMARY_FAILED)
+    return summary
+
+async def run_search_pipeline(query, post_results, send_summary, channel_id=None):
+    """ ค้นหาแล้วโพสต์ผลไปพร้อมกับเริ่มสรุป (ไม่ต้องรอกัน) คืนค่า False ถ้าไม่พบผลลัพธ์
+
+    `post_results` ใช้โพสต์ผลการค้นหา `send_summary` ใช้ส่งข้อความสรุปและต้องคืน discord.Message
+    """
+    items = await search_google_items(query)
+    if not items:
+        return False
+
+    posted = asyncio.Event()
+
+    async def post():
+        try:
+            await post_results(f"🔍 **ผลการค้นหาจาก Google:**\n{format_search_results(items)}")
+        finally:
+            posted.set()
+
+    async def send_after_results(content):
+        # ดึงหน้าเว็บและเปิด stream ไปก่อนได้ แต่ข้อความสรุปต้องขึ้นหลังผลการค้นหาเสมอ
+        await posted.wait()
+        return await send_summary(content)
+
+    await asyncio.gather(post(), stream_search_summary(items, send_after_results, channel_id))
+    return True
+
+# Cache คำตอบที่ใช้ร่วมกันทุกผู้ใช้ (exact match + near-duplicate ด้วย MinHash/LSH)
+FAQ_CACHE_SIZE = int(os.getenv("FAQ_CACHE_SIZE", "2048"))  # จำนวนคำถามสูงสุดใน cache (0 = ปิด)
+FAQ_CACHE_TTL = int(os.getenv("FAQ_CACHE_TTL", "86400"))  # วินาทีที่เก็บคำตอบไว้
+FAQ_SIMILARITY_THRESHOLD = float(os.getenv("FAQ_SIMILARITY_THRESHOLD", "0.9"))  # Jaccard ขั้นต่ำของคำถามที่ถือว่าซ้ำ
+FAQ_MIN_LENGTH = int(os.getenv("FAQ_MIN_LENGTH", "16"))  # คำถามที่สั้นกว่านี้ไม่ใช้ cache (มักขึ้นกับบริบท)
+
+# คำลงท้ายที่ไม่เปลี่ยนความหมายของคำถาม ตัดออกก่อนเทียบ
+POLITE_PARTICLES = ("ครับ", "ค่ะ", "คะ", "คับ", "จ้า", "จ้ะ", "นะ")
+# คำปฏิเสธ ถ้าสองคำถามมีจำนวนไม่เท่ากันความหมายจะกลับกัน แม้ตัวอักษรจะต่างกันนิดเดียว
+NEGATION_RE = re.compile(r"ไม่|อย่า|ห้าม|\b(?:not|no|never|cannot|without|\w+n t)\b")
+NUMBER_RE = re.compile(r"\d+")
+# คำที่อ้างถึงบทสนทนาก่อนหน้า คำถามที่มีคำเหล่านี้ตอบโดยไม่ดูบริบทไม่ได้ จึงไม่ใช้ cache
+CONTEXT_REFERENCE_RE = re.compile(
+    r"นั้น|นี้|นี่|มัน|เมื่อกี้|เมื่อกี๊|ข้างบน|ที่ว่า|ต่อจาก|อีกที|เหมือนเดิม"
+    r"|\b(?:it|its|this|that|these|those|they|them|he|she|him|her|above|again|previous)\b"
+)
 
-# ฟังก์ชันจัดเก็บแชท
-async def store_chat(user_id, message):
-    await redis_instance.set(f"chat:{user_id}", json.dumps(message), ex=86400)
+def normalize_question(text):
+    """ ตัดเครื่องหมายวรรคตอน/สัญลักษณ์ ช่องว่างซ้ำ และคำลงท้ายสุภาพออก (ไม่แตะสระ/วรรณยุกต์ไทย) """
+    cleaned = "".join(" " if unicodedata.category(ch)[0] in "PSZ" else ch for ch in text.casefold())
+    normalized = " ".join(cleaned.split())
+    stripped = True
+    while stripped:
+        stripped = False
+        for particle in POLITE_PARTICLES:
+            if normalized.endswith(particle) and len(normalized) > len(particle):
+                normalized = normalized[:-len(particle)].rstrip()
+                stripped = True
+    return normalized
 
-# ดึงประวัติแชทจาก Redis
-async def get_chat_history(user_id):
-    data = await redis_instance.get(f"chat:{user_id}")
-    return json.loads(data) if data else []
+def same_meaning_markers(a, b):
+    """ คำถามที่ใกล้เคียงกันต้องมีคำปฏิเสธเท่ากันและตัวเลขชุดเดียวกัน ไม่งั้นถือว่าคนละคำถาม """
+    return len(NEGATION_RE.findall(a)) == len(NEGATION_RE.findall(b)) and NUMBER_RE.findall(a) == NUMBER_RE.findall(b)
+
+class ResponseCache:
+    """ cache คำตอบแบบ TTL + LRU ค้นได้ทั้งแบบข้อความตรงกันและแบบใกล้เคียง
+
+    ข้อความถูกแบ่งเป็น character n-gram (ใช้กับภาษาไทยที่ไม่มีการเว้นวรรคได้)
+    แล้วทำ MinHash signature แบ่งเป็น band สำหรับ LSH ทำให้หาคำถามที่คล้ายกันได้
+    โดยไม่ต้องไล่เทียบทุกรายการ ผู้สมัครที่ได้จาก LSH จะถูกตรวจด้วย Jaccard จริงอีกครั้ง
+    """
+
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, maxsize=FAQ_CACHE_SIZE, ttl=FAQ_CACHE_TTL, threshold=FAQ_SIMILARITY_THRESHOLD,
+                 min_length=FAQ_MIN_LENGTH, shingle_size=3, bands=16, rows=4):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.min_length = min_length
+        self.shingle_size = shingle_size
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(1350812185)  # seed คงที่ signature จะได้เหมือนเดิมทุกครั้ง
+        self._perms = [(rng.randrange(1, self.PRIME), rng.randrange(0, self.PRIME)) for _ in range(bands * rows)]
+        self._entries = OrderedDict()  # normalized -> (expires_at, response, shingles, band_keys)
+        self._buckets = {}             # (band, hash ของ band) -> set ของ normalized
+        self.hits_exact = 0
+        self.hits_near = 0
+        self.misses = 0
+
+    def _shingles(self, normalized):
+        n = self.shingle_size
+        if len(normalized) <= n:
+            return {normalized}
+        return {normalized[i:i + n] for i in range(len(normalized) - n + 1)}
+
+    def _band_keys(self, shingles):
+        hashed = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles]
+        signature = [min((a * h + b) % self.PRIME for h in hashed) for a, b in self._perms]
+        return [(band, hash(tuple(signature[band * self.rows:(band + 1) * self.rows]))) for band in range(self.bands)]
+
+    def _remove(self, key):
+        _, _, _, band_keys = self._entries.pop(key)
+        for band_key in band_keys:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def _usable(self, normalized):
+        return (
+            self.maxsize > 0
+            and len(normalized) >= self.min_length
+            and not CONTEXT_REFERENCE_RE.search(normalized)
+        )
+
+    def eligible(self, text):
+        """ คำถามนี้ตอบได้โดยไม่ต้องดูบริบท และเก็บ/ค้นใน cache ได้หรือไม่ """
+        return self._usable(normalize_question(text))
+
+    def get(self, text):
+        normalized = normalize_question(text)
+        if not self._usable(normalized):
+            return None
+        now = time.monotonic()
+
+        entry = self._entries.get(normalized)
+        if entry is not None and entry[0] >= now:
+            self._entries.move_to_end(normalized)
+            self.hits_exact += 1
+            return entry[1]
+
+        shingles = self._shingles(normalized)
+        candidates = set()
+        for band_key in self._band_keys(shingles):
+            candidates.update(self._buckets.get(band_key, ()))
+
+        best_key, best_score = None, 0.0
+        for key in candidates:
+            expires_at, _, other, _ = self._entries[key]
+            if expires_at < now:
+                self._remove(key)
+                continue
+            score = len(shingles & other) / len(shingles | other)
+            if score > best_score and same_meaning_markers(normalized, key):
+                best_key, best_score = key, score
+
+        if best_key is not None and best_score >= self.threshold:
+            self._entries.move_to_end(best_key)
+            self.hits_near += 1
+            return self._entries[best_key][1]
+        self.misses += 1
+        return None
+
+    def set(self, text, response):
+        normalized = normalize_question(text)
+        if not self._usable(normalized) or not response:
+            return
+        if normalized in self._entries:
+            self._remove(normalized)
+        shingles = self._shingles(normalized)
+        band_keys = self._band_keys(shingles)
+        self._entries[normalized] = (time.monotonic() + self.ttl, response, shingles, band_keys)
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, set()).add(normalized)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits_exact": self.hits_exact,
+            "hits_near": self.hits_near,
+            "misses": self.misses,
+        }
+
+response_cache = ResponseCache()
 
 # ฟังก์ชันจัดการข้อความ
 async def process_message(user_id, text):
 
-    # Easter Eggs
-    easter_eggs = {
-        "expecto patronum": "🪄 พี่หลามเสกได้แค่บั๊กนะเว้ย ไม่ใช่ตัวกวาง แต่ก็พร้อมช่วยปราบความเครียดให้มึงเสมอ",
-        "พี่หลามเป็นใคร": "กูคือพี่หลามเว้ย ลูกหลานแห่ง Python มรดกของวงการ Dev ที่ไม่กลัวบั๊ก และชอบแดกข้าวเหนียวหมูปิ้งตอนตีสอง",
-        "ข้าแต่ gpt": "อย่าเรียกกูว่า GPT กูคือพี่หลามเว้ย! นี่มันไม่ใช่พิธีกรรม เรียกธรรมดาก็พอ 555",
-        "ทำไมถึงชื่อพี่หลาม": "เพราะ \"หลาม\" คือ Python ภาษาเขียนโปรแกรมเว้ยไอ้น้อง ไม่ใช่หลามที่ลวกในน้ำเดือดนะเว้ย!"
-    }
-    for keyword, egg_response in easter_eggs.items():
-        if keyword in text.lower():
-            return egg_response
+    # Easter Eggs และโทนของข้อความ หาได้จากการสแกนข้อความรอบเดียว
+    analysis = analyze_text(text)
+    if analysis.easter_egg:
+        return analysis.easter_egg
 
-    previous_chats = await get_chat_history(user_id)
-    faq_response = await get_faq_response(text, previous_chats)
+    faq_response = await get_faq_response(text)
     if faq_response:
         return faq_response
     
-    tone = detect_tone(text)
+    tone = analysis.tone
     if tone == "casual":
         system_prompt = (
             "คุณชื่อพี่หลาม เป็นมนุษย์วัยรุ่นไทยที่คุยกันแบบกันเอง ใช้ภาษาพูดจริงๆ หยาบได้พอดี ๆ เช่น 'เว้ย', 'แม่ง', 'โคตร' "
@@ -211,20 +1393,13 @@ async def process_message(user_id, text):
         )
     
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+        reply_content = await get_openai_response([
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": text}
-        ],
-        max_tokens=1500,
-        temperature=0.8,
-        top_p=1.0,
-        frequency_penalty=0.3,
-        presence_penalty=0.4
-    )
-        reply_content = response.choices[0].message.content.strip()
-        await store_chat(user_id, {"question": text, "response": reply_content})
+        ])
+        if not reply_content:
+            return "ขออภัย ระบบมีปัญหาในการประมวลผลข้อความของคุณ"
+        response_cache.set(text, reply_content)
         return reply_content
     except Exception as e:
         logger.error(f'เกิดข้อผิดพลาดในการเรียกใช้ OpenAI API: {e}')
@@ -235,6 +1410,22 @@ async def process_message(user_id, text):
 async def ping(interaction: discord.Interaction):
     await interaction.response.send_message(f"Pong! 🏓 Latency: {round(bot.latency * 1000)}ms")
 
+# Slash Command: Stats (เฉพาะเจ้าของ)
+@bot.tree.command(name="stats", description="ดูสถิติเวลาในแต่ละขั้นตอน (เฉพาะเจ้าของ)")
+async def stats(interaction: discord.Interaction):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("❌ คำสั่งนี้ใช้ได้เฉพาะเจ้าของบอท", ephemeral=True)
+        return
+    lines = [f"{'stage':<22}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}"]
+    for stage, histogram in sorted(metrics.histograms.items()):
+        p50, p95, p99 = (histogram.percentile(p) * 1000 for p in (50, 95, 99))
+        lines.append(f"{stage:<22}{histogram.count:>7}{p50:>8.0f}m{p95:>8.0f}m{p99:>8.0f}m")
+    counters = {**metrics.counters, **metrics.gauges()}
+    lines.append("")
+    lines.extend(f"{name}: {value:g}" if isinstance(value, float) else f"{name}: {value}" for name, value in sorted(counters.items()))
+    report = "\n".join(lines)
+    await interaction.response.send_message(f"📊 **สถิติ (ms)**\n```\n{report[:DISCORD_MESSAGE_LIMIT - 40]}\n```", ephemeral=True)
+
 # Slash Command: Shutdown (เฉพาะเจ้าของ)
 @bot.tree.command(name="shutdown", description="ปิดบอท (เฉพาะเจ้าของ)")
 @commands.is_owner()
@@ -245,49 +1436,161 @@ async def shutdown(interaction: discord.Interaction):
 # Slash Command: Google Search
 @bot.tree.command(name="ค้นหา", description="ค้นหาข้อมูลจาก Google")
 async def search(interaction: discord.Interaction, query: str):
-    search_results = search_google(query)
-    if search_results == "ไม่พบข้อมูลจาก Google":
-        await interaction.response.send_message("❌ ไม่พบข้อมูลที่ต้องการ")
-    else:
-        await interaction.response.send_message(f"🔍 **ผลการค้นหาจาก Google:**\n{search_results}")
-
-        summary = summarize_with_gpt(search_results)
-        await interaction.followup.send(f"📝 **สรุปข้อมูลโดย AI:**\n{summary}")
+    # ค้นหาและสรุปอาจนานเกิน 3 วินาทีที่ Discord รอ interaction จึง defer ไว้ก่อน
+    await interaction.response.defer(thinking=True)
+    request = SearchRequest(
+        interaction.user,
+        interaction.channel_id,
+        interaction.followup.send,
+        functools.partial(interaction.followup.send, wait=True),
+    )
+    await search_scheduler.submit(request, query)
 
 async def create_table():
-    """ สร้างตาราง context ถ้ายังไม่มี """
+    """ สร้างตาราง chat_messages ถ้ายังไม่มี และย้ายข้อมูลจากตาราง context เดิม """
     try:
         async with bot.pool.acquire() as con:
-            await con.execute("""
-                CREATE TABLE IF NOT EXISTS context (
-                    id BIGINT PRIMARY KEY,
-                    chatcontext TEXT[] DEFAULT ARRAY[]::TEXT[]
-                )
-            """)
-            logger.info("ตรวจสอบและสร้างตาราง context แล้ว")
+            # กันหลาย worker สร้างตารางพร้อมกัน (CREATE TABLE IF NOT EXISTS ชนกันเองได้)
+            async with con.transaction():
+                await con.execute("SELECT pg_advisory_xact_lock(hashtext('chat_messages_schema'))")
+                # หนึ่งแถวต่อหนึ่งข้อความ primary key (guild, channel, seq) ใช้ดึงข้อความล่าสุด N รายการได้ด้วย index
+                await con.execute("""
+                    CREATE TABLE IF NOT EXISTS chat_messages (
+                        guild_id BIGINT NOT NULL,
+                        channel_id BIGINT NOT NULL,
+                        seq BIGSERIAL,
+                        content TEXT NOT NULL,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        PRIMARY KEY (guild_id, channel_id, seq)
+                    )
+                """)
+                await con.execute("""
+                    CREATE INDEX IF NOT EXISTS chat_messages_created_at_idx ON chat_messages (created_at)
+                """)
+                await con.execute("""
+                    CREATE TABLE IF NOT EXISTS chat_summaries (
+                        guild_id BIGINT NOT NULL,
+                        channel_id BIGINT NOT NULL,
+                        summary TEXT NOT NULL,
+                        last_seq BIGINT NOT NULL,
+                        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        PRIMARY KEY (guild_id, channel_id)
+                    )
+                """)
+                await con.execute("""
+                    CREATE TABLE IF NOT EXISTS reply_jobs (
+                        id BIGSERIAL PRIMARY KEY,
+                        guild_id BIGINT NOT NULL,
+                        channel_id BIGINT NOT NULL,
+                        message_id BIGINT NOT NULL,
+                        author_name TEXT NOT NULL,
+                        text TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INT NOT NULL DEFAULT 0,
+                        last_error TEXT,
+                        run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        started_at TIMESTAMPTZ,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                """)
+                await con.execute("""
+                    CREATE INDEX IF NOT EXISTS reply_jobs_pending_idx ON reply_jobs (run_after) WHERE status = 'pending'
+                """)
+                await con.execute("""
+                    CREATE TABLE IF NOT EXISTS bot_meta (
+                        key TEXT PRIMARY KEY,
+                        value TEXT NOT NULL,
+                        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                """)
+            logger.info("ตรวจสอบและสร้างตาราง chat_messages, chat_summaries, reply_jobs และ bot_meta แล้ว")
+            await migrate_legacy_context(con)
     except Exception as e:
         logger.error(f'เกิดข้อผิดพลาดในการสร้างตาราง: {e}')
 
+async def migrate_legacy_context(con):
+    """ ย้ายข้อมูลจากคอลัมน์ context.chatcontext (TEXT[]) มาเป็นแถวใน chat_messages """
+    async with con.transaction():
+        # กันหลาย process ย้ายข้อมูลพร้อมกัน
+        await con.execute("SELECT pg_advisory_xact_lock(hashtext('chat_messages_migration'))")
+        if not await con.fetchval("SELECT to_regclass('context') IS NOT NULL"):
+            return
+        # ตาราง context เดิมไม่ได้เก็บ channel จึงย้ายเข้า CHANNEL_ID ซึ่งเป็นห้องเดียวที่บอทตอบ
+        status = await con.execute("""
+            INSERT INTO chat_messages (guild_id, channel_id, content)
+            SELECT c.id, $1, m.content
+            FROM context c
+            CROSS JOIN LATERAL unnest(c.chatcontext) WITH ORDINALITY AS m(content, ord)
+            WHERE m.content IS NOT NULL
+            ORDER BY c.id, m.ord
+        """, CHANNEL_ID)
+        await con.execute("ALTER TABLE context RENAME TO context_legacy")
+    logger.info(f"✅ ย้ายข้อมูลจากตาราง context เดิมแล้ว ({status}) เก็บตารางเดิมไว้ที่ context_legacy")
+
+async def get_bot_meta(key):
+    """ อ่านค่าที่บอทเก็บไว้ข้าม restart (PostgreSQL ก่อน ถ้าไม่มีใช้ Redis) """
+    try:
+        if getattr(bot, "pool", None) is not None:
+            async with bot.pool.acquire() as con:
+                return await con.fetchval("SELECT value FROM bot_meta WHERE key = $1", key)
+        if redis_instance is not None:
+            return await redis_instance.get(f"bot_meta:{key}")
+    except Exception as e:
+        logger.error(f'get_bot_meta: {e}')
+    return None
+
+async def set_bot_meta(key, value):
+    try:
+        if getattr(bot, "pool", None) is not None:
+            async with bot.pool.acquire() as con:
+                await con.execute("""
+                    INSERT INTO bot_meta (key, value) VALUES ($1, $2)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()
+                """, key, value)
+        elif redis_instance is not None:
+            await redis_instance.set(f"bot_meta:{key}", value)
+    except Exception as e:
+        logger.error(f'set_bot_meta: {e}')
+
+def command_tree_hash():
+    """ hash ของ slash command ทั้งหมด ใช้ตรวจว่าต้อง sync กับ Discord ใหม่หรือไม่ """
+    payload = []
+    for command in bot.tree.get_commands():
+        try:
+            payload.append(command.to_dict(bot.tree))
+        except TypeError:
+            payload.append(command.to_dict())  # discord.py รุ่นเก่ารับ to_dict() แบบไม่มี argument
+    payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+async def sync_command_tree():
+    """ sync slash command เฉพาะเมื่อคำสั่งเปลี่ยนจากที่ sync ครั้งล่าสุด (tree.sync ติด rate limit ของ Discord) """
+    key = f"command_tree_hash:{bot.application_id}"
+    current = command_tree_hash()
+    if await get_bot_meta(key) == current:
+        logger.info("✅ Slash Commands ไม่เปลี่ยนแปลง ข้ามการซิงค์")
+        return
+    await bot.tree.sync()
+    await set_bot_meta(key, current)
+    logger.info("✅ ซิงค์ Slash Commands สำเร็จ!")
+
+# on_ready ถูกเรียกซ้ำทุกครั้งที่ gateway reconnect งานเริ่มต้นจึงต้องทำแค่ครั้งแรก
+_startup_done = False
+
 @bot.event
 async def on_ready():
-    global redis_instance
+    global _startup_done
+    if _startup_done:
+        logger.info(f"🔄 {bot.user} เชื่อมต่อ Discord ใหม่แล้ว")
+        return
+    logger.info(f"🚀 บอท {bot.user} พร้อมใช้งาน!")
     try:
-        logging.info(f"🚀 บอท {bot.user} พร้อมใช้งาน!")
-        await bot.tree.sync()
-        logger.info("✅ ซิงค์ Slash Commands สำเร็จ!")
-
-        logger.info("🚀 บอทกำลังเริ่มต้น on_ready()...")
-        await setup_postgres()
-        await setup_redis()
-        if bot.pool is None:
-            logger.error("❌ PostgreSQL connection pool ยังไม่ได้ถูกกำหนดค่า")
-        if redis_instance is None:
-            logger.error("❌ Redis instance ยังไม่ได้ถูกกำหนดค่า")
-        logger.info(f"✅ {bot.user} เชื่อมต่อสำเร็จ!")
+        await sync_command_tree()
     except Exception as e:
-        logger.error(f"❌ เกิดข้อผิดพลาดใน on_ready: {e}")
-        bot.pool = None
-        redis_instance = None
+        # ยังไม่ตั้ง _startup_done จะลองซิงค์ใหม่ตอน on_ready ครั้งถัดไป
+        logger.error(f"❌ เกิดข้อผิดพลาดในการซิงค์ Slash Commands: {e}")
+        return
+    _startup_done = True
 
 async def send_message_to_channel(channel_id, message):
     """ ส่งข้อความไปที่ห้อง Discord """
@@ -298,163 +1601,1243 @@ async def send_message_to_channel(channel_id, message):
     except Exception as e:
         logger.error(f'เกิดข้อผิดพลาดในการส่งข้อความไปยังช่อง: {e}')
 
-async def get_guild_x(guild, x):
+# คำสั่ง SQL ของข้อมูลแต่ละประเภทที่ get_guild_x ดึงได้
+GUILD_X_QUERIES = {
+    "chatcontext": """
+        SELECT content FROM chat_messages
+        WHERE guild_id = $1 AND channel_id = $2
+        ORDER BY seq DESC
+        LIMIT $3
+    """,
+    "summary": """
+        SELECT summary AS content FROM chat_summaries
+        WHERE guild_id = $1 AND channel_id = $2
+        LIMIT $3
+    """,
+}
+
+# ห้องที่มีข้อความใหม่ตั้งแต่การ prune รอบก่อน
+context_dirty = set()
+
+class ContextWriteBuffer:
+    """ write-behind queue ของ chat_messages รวมข้อความจากทุก guild แล้ว COPY ลง Postgres เป็นชุด
+
+    flush เมื่อค้างครบ CONTEXT_FLUSH_SIZE หรือทุก CONTEXT_FLUSH_INTERVAL วินาที
+    ข้อความที่ยังไม่ถูกเขียนลง database ยังอ่านได้ผ่าน pending_for (read-your-writes)
+    """
+
+    def __init__(self, flush_size=CONTEXT_FLUSH_SIZE, flush_interval=CONTEXT_FLUSH_INTERVAL, max_pending=CONTEXT_BUFFER_LIMIT):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.generation = 0   # เพิ่มขึ้นทุกครั้งที่ flush สำเร็จ
+        self._pending = []    # (guild, channel, content) ที่ยังไม่ได้เริ่มเขียน
+        self._inflight = []   # ชุดที่กำลังเขียนลง database
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def add(self, guild, channel, content):
+        self._pending.append((guild, channel, content))
+        if len(self._pending) >= self.flush_size:
+            self._wakeup.set()
+
+    @property
+    def pending_count(self):
+        return len(self._pending) + len(self._inflight)
+
+    def pending_for(self, guild, channel):
+        """ ข้อความของห้องนี้ที่ยังไม่ได้ commit ลง database เรียงจากเก่าไปใหม่ """
+        return [content for g, ch, content in self._inflight + self._pending if g == guild and ch == channel]
+
+    async def flush(self):
+        """ เขียนข้อความที่ค้างทั้งหมดลง chat_messages ด้วย COPY ครั้งเดียว """
+        async with self._lock:
+            if not self._pending or getattr(bot, "pool", None) is None:
+                return 0
+            batch, self._pending = self._pending, []
+            self._inflight = batch
+            try:
+                with metrics.timer("context_flush"):
+                    async with bot.pool.acquire() as con:
+                        await con.copy_records_to_table(
+                            "chat_messages", records=batch, columns=["guild_id", "channel_id", "content"]
+                        )
+            except Exception as e:
+                logger.error(f'ContextWriteBuffer.flush: {e}')
+                # เก็บกลับเข้าคิวเพื่อลองใหม่รอบหน้า (ตัดของเก่าทิ้งถ้าเกินขีดจำกัด)
+                self._pending = (batch + self._pending)[-self.max_pending:]
+                return 0
+            finally:
+                self._inflight = []
+            self.generation += 1
+            context_dirty.update((g, ch) for g, ch, _ in batch)
+            return len(batch)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = start_background_task(self.run())
+
+    async def close(self):
+        """ หยุด background task แล้ว flush ข้อความที่เหลือก่อนปิดบอท """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+context_writer = ContextWriteBuffer()
+
+# Cache บริบทการสนทนาใน Redis: list ต่อห้อง ข้อความใหม่สุดอยู่หัว list
+# ถ้าประวัติทั้งหมดสั้นกว่า CONTEXT_CACHE_SIZE จะมี sentinel ต่อท้ายไว้ เพื่อให้ห้องที่ยังไม่มีประวัติก็ cache ได้
+CONTEXT_CACHE_SENTINEL = "\x00"
+
+# ห้องที่เขียน cache ไม่สำเร็จ ต้องล้าง cache ก่อนใช้ครั้งต่อไป
+context_cache_stale = set()
+
+def context_cache_key(guild, channel):
+    return f"ctx:{guild}:{channel}"
+
+def context_version_key(guild, channel):
+    """ ตัวนับที่เพิ่มทุกครั้งที่มีข้อความใหม่ ใช้ตรวจว่าระหว่าง warm cache มีใครเขียนแทรกหรือไม่ """
+    return f"ctxv:{guild}:{channel}"
+
+async def context_cache_version(guild, channel):
+    if redis_instance is None:
+        return None
+    try:
+        return await redis_instance.get(context_version_key(guild, channel))
+    except Exception as e:
+        logger.warning(f'context_cache_version: {e}')
+        return None
+
+async def context_cache_get(guild, channel, limit):
+    """ อ่านบริบทจาก Redis (คืน None ถ้า cache miss หรือ Redis ใช้ไม่ได้) """
+    if redis_instance is None or limit > CONTEXT_CACHE_SIZE:
+        return None
+    key = context_cache_key(guild, channel)
+    try:
+        if (guild, channel) in context_cache_stale:
+            await redis_instance.delete(key)
+            context_cache_stale.discard((guild, channel))
+            return None
+        async with redis_instance.pipeline(transaction=False) as pipe:
+            pipe.lrange(key, 0, limit - 1)
+            pipe.expire(key, CONTEXT_CACHE_TTL)
+            values, _ = await pipe.execute()
+    except Exception as e:
+        logger.warning(f'context_cache_get: {e}')
+        return None
+    if not values:
+        return None
+    return [value for value in reversed(values) if value != CONTEXT_CACHE_SENTINEL]
+
+async def context_cache_fill(guild, channel, entries, version):
+    """ warm cache ของห้องด้วยข้อความจาก database (entries เรียงจากเก่าไปใหม่)
+
+    `version` คือค่าของ context_cache_version ก่อนอ่าน database ถ้ามีข้อความใหม่เข้ามาหลังจากนั้น
+    (LPUSHX ของข้อความนั้นไม่มีผลเพราะ key ยังไม่มี) จะไม่ warm cache ด้วยข้อมูลที่ขาดข้อความนั้น
+    """
+    if redis_instance is None:
+        return
+    key = context_cache_key(guild, channel)
+    version_key = context_version_key(guild, channel)
+    values = list(reversed(entries[-CONTEXT_CACHE_SIZE:]))
+    if len(entries) < CONTEXT_CACHE_SIZE:
+        values.append(CONTEXT_CACHE_SENTINEL)
+    try:
+        async with redis_instance.pipeline(transaction=True) as pipe:
+            await pipe.watch(version_key)
+            if await pipe.get(version_key) != version:
+                metrics.incr("context_cache_fill_conflict")
+                return
+            pipe.multi()
+            pipe.delete(key)
+            pipe.rpush(key, *values)
+            pipe.expire(key, CONTEXT_CACHE_TTL)
+            await pipe.execute()
+    except redis.WatchError:
+        metrics.incr("context_cache_fill_conflict")
+    except Exception as e:
+        logger.warning(f'context_cache_fill: {e}')
+
+async def context_cache_push(guild, channel, content):
+    """ write-through: เพิ่มข้อความเข้า cache เฉพาะห้องที่ถูก warm ไว้แล้ว (LPUSHX) """
+    if redis_instance is None:
+        return
+    key = context_cache_key(guild, channel)
+    try:
+        async with redis_instance.pipeline(transaction=True) as pipe:
+            pipe.lpushx(key, content)
+            pipe.ltrim(key, 0, CONTEXT_CACHE_SIZE - 1)
+            pipe.expire(key, CONTEXT_CACHE_TTL)
+            pipe.incr(context_version_key(guild, channel))
+            pipe.expire(context_version_key(guild, channel), CONTEXT_CACHE_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f'context_cache_push: {e}')
+        # cache ของห้องนี้อาจขาดข้อความ ล้างทิ้งเพื่อให้ไปอ่านจาก database แทน
+        context_cache_stale.add((guild, channel))
+
+@metrics.timed("get_guild_x")
+async def get_guild_x(guild, x, channel=CHANNEL_ID, limit=CONTEXT_WINDOW):
+    """ ดึงข้อมูล x ของห้องใน guild (chatcontext = ข้อความล่าสุด limit รายการ เรียงจากเก่าไปใหม่) """
+    if x == "chatcontext":
+        cached = await context_cache_get(guild, channel, limit)
+        if cached is not None:
+            metrics.incr("context_cache_hit")
+            return cached
+        metrics.incr("context_cache_miss")
     if not hasattr(bot, "pool") or bot.pool is None:
         logger.warning("⚠️ Database ยังไม่พร้อมใช้งาน")
         return None
+    # cache miss ดึงให้พอ warm cache ในครั้งเดียว
+    fetch_limit = max(limit, CONTEXT_CACHE_SIZE) if x == "chatcontext" else limit
     try:
-        async with bot.pool.acquire() as con:
-            return await con.fetchval(f"""
-                SELECT COALESCE({x}, ARRAY[]::TEXT[]) 
-                FROM context WHERE id = $1
-            """, guild)
+        version = await context_cache_version(guild, channel) if x == "chatcontext" else None
+        for _ in range(2):
+            generation = context_writer.generation
+            async with bot.pool.acquire() as con:
+                rows = await con.fetch(GUILD_X_QUERIES[x], guild, channel, fetch_limit)
+            # ถ้ามีการ flush ระหว่าง query ให้อ่านใหม่ ไม่งั้นข้อความชุดนั้นจะหายไปจากผลลัพธ์
+            if context_writer.generation == generation:
+                break
+        result = [row["content"] for row in reversed(rows)]
+        if x == "chatcontext":
+            result = (result + context_writer.pending_for(guild, channel))[-fetch_limit:]
+            await context_cache_fill(guild, channel, result, version)
+        return result[-limit:]
     except Exception as e:
         logger.error(f'get_guild_x: {e}')
         return None
 
-async def chatcontext_append(guild, message):
+@metrics.timed("chatcontext_append")
+async def chatcontext_append(guild, message, channel=CHANNEL_ID):
+    """ เพิ่มข้อความเข้าบริบทการสนทนา (write-through ไป Redis และ write-behind ไป Postgres) """
     if not hasattr(bot, "pool") or bot.pool is None:
         logger.warning("⚠️ Database ยังไม่พร้อมใช้งาน")
         return
-    try:
-        async with bot.pool.acquire() as con:
+    context_writer.add(guild, channel, message)
+    await context_cache_push(guild, channel, message)
+    context_compactor.note(guild, channel, message)
+
+async def prune_chat_context(full=False, table_wide=True):
+    """ ลบข้อความที่เกิน CONTEXT_RETENTION ต่อห้อง และที่เก่ากว่า CONTEXT_MAX_AGE_DAYS
+
+    รอบปกติตรวจเฉพาะห้องที่ process นี้เพิ่ง flush (context_dirty) จึงต้องรันในทุก worker
+    ส่วนงานที่ไล่ทั้งตาราง (full และลบตามอายุ) ให้ worker เดียวทำด้วย table_wide
+    """
+    if not hasattr(bot, "pool") or bot.pool is None:
+        return
+    async with bot.pool.acquire() as con:
+        if CONTEXT_RETENTION > 0:
+            if full and table_wide:
+                # รอบแรกหลังเริ่มบอท ตรวจทุกห้อง (รวมข้อมูลที่เพิ่งย้ายมา)
+                await con.execute("""
+                    DELETE FROM chat_messages m
+                    USING (
+                        SELECT guild_id, channel_id, seq, row_number() OVER (
+                            PARTITION BY guild_id, channel_id ORDER BY seq DESC
+                        ) AS rn
+                        FROM chat_messages
+                    ) ranked
+                    WHERE ranked.rn > $1
+                      AND m.guild_id = ranked.guild_id
+                      AND m.channel_id = ranked.channel_id
+                      AND m.seq = ranked.seq
+                """, CONTEXT_RETENTION)
+            else:
+                # รอบปกติ ตรวจเฉพาะห้องที่มีข้อความใหม่ ใช้ index ของ (guild, channel, seq)
+                dirty = list(context_dirty)
+                context_dirty.clear()
+                for guild, channel in dirty:
+                    await con.execute("""
+                        DELETE FROM chat_messages
+                        WHERE guild_id = $1 AND channel_id = $2 AND seq <= (
+                            SELECT seq FROM chat_messages
+                            WHERE guild_id = $1 AND channel_id = $2
+                            ORDER BY seq DESC
+                            OFFSET $3 LIMIT 1
+                        )
+                    """, guild, channel, CONTEXT_RETENTION)
+        if CONTEXT_MAX_AGE_DAYS > 0 and table_wide:
             await con.execute("""
-                INSERT INTO context (id, chatcontext)
-                VALUES ($1, ARRAY[$2]::TEXT[])
-                ON CONFLICT (id) DO UPDATE 
-                SET chatcontext = array_append(
-                    COALESCE(context.chatcontext, ARRAY[]::TEXT[]),  
-                    $2
-                )
-            """, guild, message)
-    except Exception as e:
-        logger.error(f'chatcontext_append: {e}')
+                DELETE FROM chat_messages WHERE created_at < now() - make_interval(days => $1)
+            """, CONTEXT_MAX_AGE_DAYS)
 
-async def get_faq_response(new_question, previous_questions):
-    for question in previous_questions:
-        if new_question.lower() in question['question'].lower():
-            return question['response']
-    return None
+async def chat_context_pruner(table_wide=True):
+    """ background task ที่ prune บริบทการสนทนาเป็นระยะ (ไม่อยู่ใน path ของการตอบข้อความ) """
+    full = True
+    while True:
+        try:
+            await prune_chat_context(full=full, table_wide=table_wide)
+            full = False
+        except Exception as e:
+            logger.error(f'prune_chat_context: {e}')
+        await asyncio.sleep(CONTEXT_PRUNE_INTERVAL)
+
+# summary ล่าสุดของแต่ละห้อง ("" = ยังไม่มี summary)
+summary_cache = TTLCache(1024, CONTEXT_CACHE_TTL)
+
+async def get_chat_summary(guild, channel):
+    """ ดึง rolling summary ของห้อง (อ่านจาก database แค่ครั้งแรก หลังจากนั้นใช้ cache) """
+    key = (guild, channel)
+    summary = summary_cache.get(key)
+    if summary is None:
+        rows = await get_guild_x(guild, "summary", channel, 1)
+        if rows is None:
+            return ""
+        summary = rows[0] if rows else ""
+        summary_cache.set(key, summary)
+    return summary
+
+@metrics.timed("summary_compaction")
+async def summarize_context(summary, lines):
+    """ พับข้อความใหม่เข้ากับ summary เดิมด้วยโมเดลราคาถูก (None ถ้าไม่สำเร็จ) """
+    conversation = "\n".join(lines)
+    messages = [
+        {"role": "system", "content": (
+            "คุณสรุปบทสนทนาในห้องแชท Discord ให้พี่หลาม (บอท) ใช้จำเรื่องที่คุยกันไปแล้ว "
+            "เก็บชื่อคน เรื่องที่คุย ข้อเท็จจริง ความชอบ และสิ่งที่ตกลงกันไว้ ตัดคำทักทายและเรื่องไร้สาระทิ้ง "
+            "เขียนเป็นข้อความภาษาไทยสั้นๆ กระชับ"
+        )},
+        {"role": "user", "content": (
+            f"สรุปเดิม:\n{summary or '(ยังไม่มี)'}\n\n"
+            f"บทสนทนาที่เกิดขึ้นต่อจากนั้น:\n{conversation}\n\n"
+            "รวมทั้งสองส่วนเป็นสรุปใหม่ฉบับเดียว"
+        )},
+    ]
+    return await get_openai_response(
+        messages,
+        model=SUMMARY_MODEL,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        temperature=0.3,
+        frequency_penalty=0.0,
+        presence_penalty=0.0
+    )
+
+class ContextCompactor:
+    """ พับข้อความเก่าของแต่ละห้องเข้า rolling summary ใน background (ไม่อยู่ใน path ของการตอบ)
+
+    เริ่มทำงานเมื่อข้อความใหม่ครบ SUMMARY_TRIGGER_MESSAGES หรือรวมกันเกิน SUMMARY_TRIGGER_TOKENS
+    ข้อความล่าสุดเท่าจำนวนที่ build_prompt ใส่เป็นประวัติได้ในรอบล่าสุดจะยังไม่ถูกพับ
+    (ไม่ให้ข้อความเดียวกันอยู่ทั้งใน summary และในประวัติ) ถ้าสรุปไม่สำเร็จจะพักห้องนั้นไว้ก่อน
+    """
+
+    def __init__(self):
+        self._counters = {}   # (guild, channel) -> [จำนวนข้อความ, จำนวน token] ตั้งแต่สรุปรอบก่อน
+        self._running = set()
+        self._history_sizes = {}  # (guild, channel) -> จำนวนข้อความประวัติที่ prompt ล่าสุดใส่ได้
+        self._failures = {}       # (guild, channel) -> (จำนวนครั้งที่ล้มเหลวติดกัน, เวลาที่ลองใหม่ได้)
+
+    def note_prompt(self, guild, channel, history_size):
+        """ บันทึกว่า prompt ล่าสุดของห้องใส่ประวัติได้กี่ข้อความ """
+        self._history_sizes[(guild, channel)] = history_size
+
+    def _record_failure(self, key):
+        failures = self._failures.get(key, (0, 0.0))[0] + 1
+        cooldown = min(SUMMARY_FAILURE_COOLDOWN * 2 ** (failures - 1), 3600)
+        self._failures[key] = (failures, time.monotonic() + cooldown)
+        metrics.incr("summary_compaction_failed")
+        logger.warning(f"⚠️ สรุปบทสนทนาของห้อง {key[1]} ไม่สำเร็จ พักไว้ {cooldown:.0f} วินาที")
+
+    def note(self, guild, channel, line):
+        key = (guild, channel)
+        counter = self._counters.setdefault(key, [0, 0])
+        counter[0] += 1
+        counter[1] += count_tokens(line)
+        if key in self._running:
+            return
+        failure = self._failures.get(key)
+        if failure is not None and time.monotonic() < failure[1]:
+            return
+        if counter[0] >= SUMMARY_TRIGGER_MESSAGES or counter[1] >= SUMMARY_TRIGGER_TOKENS:
+            self._running.add(key)
+            start_background_task(self._compact(key))
+
+    async def _compact(self, key):
+        guild, channel = key
+        try:
+            # ให้ข้อความที่ยังค้างใน write-behind buffer ลง database ก่อน
+            await context_writer.flush()
+            async with bot.pool.acquire() as con:
+                row = await con.fetchrow("""
+                    SELECT summary, last_seq FROM chat_summaries WHERE guild_id = $1 AND channel_id = $2
+                """, guild, channel)
+                summary, last_seq = (row["summary"], row["last_seq"]) if row else ("", 0)
+                rows = await con.fetch("""
+                    SELECT seq, content FROM chat_messages
+                    WHERE guild_id = $1 AND channel_id = $2 AND seq > $3 AND seq <= (
+                        SELECT seq FROM chat_messages
+                        WHERE guild_id = $1 AND channel_id = $2
+                        ORDER BY seq DESC
+                        OFFSET $4 LIMIT 1
+                    )
+                    ORDER BY seq
+                    LIMIT $5
+                """, guild, channel, last_seq, self._history_sizes.get(key, SUMMARY_KEEP_RECENT), SUMMARY_BATCH_SIZE)
+            if not rows:
+                self._counters.pop(key, None)
+                return
+
+            new_summary = await summarize_context(summary, [r["content"] for r in rows])
+            if not new_summary:
+                # เก็บตัวนับไว้ จะลองใหม่เมื่อพ้นช่วงพักแล้วมีข้อความถัดไป
+                self._record_failure(key)
+                return
+
+            async with bot.pool.acquire() as con:
+                await con.execute("""
+                    INSERT INTO chat_summaries (guild_id, channel_id, summary, last_seq)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (guild_id, channel_id) DO UPDATE
+                    SET summary = EXCLUDED.summary, last_seq = EXCLUDED.last_seq, updated_at = now()
+                """, guild, channel, new_summary, rows[-1]["seq"])
+            summary_cache.set(key, new_summary)
+            self._counters.pop(key, None)
+            self._failures.pop(key, None)
+            logger.info(f"🗜️ พับ {len(rows)} ข้อความเข้า summary ของ guild {guild} ห้อง {channel}")
+        except Exception as e:
+            logger.error(f'ContextCompactor: {e}')
+            self._record_failure(key)
+        finally:
+            self._running.discard(key)
+
+context_compactor = ContextCompactor()
+
+async def get_faq_response(new_question):
+    """ หาคำตอบของคำถามเดิมหรือคำถามที่คล้ายกันมากจาก cache ที่ใช้ร่วมกันทุกผู้ใช้ """
+    return response_cache.get(new_question)
+
+# ตารางคำสำคัญ (easter eggs และคำบ่งบอกโทน) โหลดจากไฟล์และ reload ได้โดยไม่ต้องรีสตาร์ท
+KEYWORDS_FILE = os.getenv("KEYWORDS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "keywords.json"))
+KEYWORDS_RELOAD_INTERVAL = float(os.getenv("KEYWORDS_RELOAD_INTERVAL", "5"))  # วินาทีระหว่างการเช็คว่าไฟล์ถูกแก้หรือไม่
+TONE_MIN_SCORE = float(os.getenv("TONE_MIN_SCORE", "1.0"))  # คะแนนขั้นต่ำก่อนจะถือว่าข้อความมีโทนนั้น
+
+class KeywordMatcher:
+    """ Aho-Corasick automaton หาคำสำคัญทุกคำในข้อความด้วยการสแกนรอบเดียว
+
+    entries เป็นลำดับของ (คำ, payload) เวลาที่ใช้ต่อข้อความขึ้นกับความยาวข้อความ
+    และจำนวนคำที่เจอ ไม่ขึ้นกับจำนวนคำในตาราง
+    """
+
+    def __init__(self, entries):
+        self._goto = [{}]    # state -> {ตัวอักษร: state ถัดไป}
+        self._fail = [0]
+        self._output = [[]]  # state -> payload ของคำที่จบที่ state นี้
+        for keyword, payload in entries:
+            self._add(keyword.lower(), payload)
+        self._build()
+
+    def _add(self, keyword, payload):
+        if not keyword:
+            return
+        state = 0
+        for ch in keyword:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = nxt
+        self._output[state].append(payload)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def scan(self, text):
+        """ คืน payload ของทุกคำที่พบใน text (text ต้องเป็นตัวพิมพ์เล็กแล้ว) """
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        found = []
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.extend(output[state])
+        return found
+
+class TextAnalysis:
+    def __init__(self, easter_egg, tone_scores):
+        self.easter_egg = easter_egg
+        self.tone_scores = tone_scores
+
+    @property
+    def tone(self):
+        """ โทนที่คะแนนสูงสุด (เท่ากันให้โทนที่อยู่ก่อนในตาราง) หรือ neutral ถ้าไม่ถึง TONE_MIN_SCORE """
+        best, best_score = "neutral", 0.0
+        for tone, score in self.tone_scores.items():
+            if score > best_score:
+                best, best_score = tone, score
+        return best if best_score >= TONE_MIN_SCORE else "neutral"
+
+class KeywordTables:
+    """ โหลดตารางคำสำคัญจาก KEYWORDS_FILE สร้าง automaton ครั้งเดียว และ reload เมื่อไฟล์เปลี่ยน """
+
+    def __init__(self, path=KEYWORDS_FILE, reload_interval=KEYWORDS_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.tones = []
+        self.matcher = KeywordMatcher([])
+        self._mtime = None
+        self._checked_at = 0.0
+        self.reload()
+
+    def reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            matcher, tones, count = self._build(data)
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            logger.error(f"❌ โหลดไฟล์คำสำคัญ {self.path} ไม่สำเร็จ ใช้ตารางเดิมต่อ: {e}")
+            # จำ mtime ไว้ ไฟล์ที่เสียจะไม่ถูกอ่านซ้ำจนกว่าจะถูกแก้อีกครั้ง
+            with contextlib.suppress(OSError):
+                self._mtime = os.path.getmtime(self.path)
+            return False
+
+        self.matcher, self.tones, self._mtime = matcher, tones, mtime
+        logger.info(f"✅ โหลดคำสำคัญ {count} คำจาก {self.path}")
+        return True
+
+    @staticmethod
+    def _build(data):
+        """ ตรวจรูปแบบของตารางและสร้าง automaton (raise ValueError/TypeError ถ้ารูปแบบผิด) """
+        def keyword(word):
+            if not isinstance(word, str) or not word.strip():
+                raise ValueError(f"คำสำคัญต้องเป็นข้อความที่ไม่ว่าง: {word!r}")
+            return word
+
+        if not isinstance(data, dict):
+            raise TypeError("ไฟล์คำสำคัญต้องเป็น JSON object")
+        entries = []
+        # payload ของ easter egg คือ (ลำดับในตาราง, คำตอบ) คำที่อยู่ก่อนมีสิทธิ์ก่อนเมื่อเจอหลายคำ
+        for order, (word, response) in enumerate(data.get("easter_eggs", {}).items()):
+            if not isinstance(response, str):
+                raise TypeError(f"คำตอบของ easter egg {word!r} ต้องเป็นข้อความ")
+            entries.append((keyword(word), ("egg", order, response)))
+        tones = list(data.get("tone", {}))
+        for tone, words in data.get("tone", {}).items():
+            for word, weight in words.items():
+                if isinstance(weight, bool) or not isinstance(weight, (int, float)):
+                    raise TypeError(f"น้ำหนักของคำ {word!r} ในโทน {tone!r} ต้องเป็นตัวเลข")
+                entries.append((keyword(word), ("tone", tone, float(weight))))
+        return KeywordMatcher(entries), tones, len(entries)
+
+    def current(self):
+        """ คืน automaton ปัจจุบัน เช็ค mtime ของไฟล์ไม่บ่อยกว่า reload_interval """
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            try:
+                if os.path.getmtime(self.path) != self._mtime:
+                    self.reload()
+            except OSError:
+                pass
+        return self
+
+    def analyze(self, text):
+        best_egg = None
+        scores = {tone: 0.0 for tone in self.tones}
+        for payload in self.matcher.scan(text.lower()):
+            if payload[0] == "egg":
+                if best_egg is None or payload[1] < best_egg[0]:
+                    best_egg = (payload[1], payload[2])
+            else:
+                scores[payload[1]] += payload[2]
+        return TextAnalysis(best_egg[1] if best_egg else None, scores)
+
+keyword_tables = KeywordTables()
+
+def analyze_text(text):
+    """ หา easter egg และคะแนนโทนของข้อความด้วยการสแกนรอบเดียว """
+    return keyword_tables.current().analyze(text)
 
 def detect_tone(text):
-    casual_words = ["555", "ฮา", "โคตร", "เว้ย", "เห้ย", "แง", "แม่ง", "สัส", "ตึง", "บ้ง", "เฉย"]
-    formal_words = ["เรียน", "กรุณา", "ขอสอบถาม", "ขอข้อมูล", "ติดต่อกลับ", "ดำเนินการ"]
-    text_lower = text.lower()
-
-    if any(word in text_lower for word in casual_words):
-        return "casual"
-    elif any(word in text_lower for word in formal_words):
-        return "formal"
-    return "neutral"
-    formal_words = ["เรียน", "กรุณา", "ขอสอบถาม"]
-    if any(word in text for word in casual_words):
-        return "casual"
-    elif any(word in text for word in formal_words):
-        return "formal"
-    return "neutral"
+    return analyze_text(text).tone
 
+@metrics.timed("send_long_message")
 async def send_long_message(channel, content):
-    for chunk in [content[i:i+2000] for i in range(0, len(content), 2000)]:
+    for chunk in [content[i:i+DISCORD_MESSAGE_LIMIT] for i in range(0, len(content), DISCORD_MESSAGE_LIMIT)]:
         await channel.send(chunk)
 
+# ข้อความเมื่อระบบขัดข้อง
+ERROR_MESSAGES = [
+    "แม่งงง ระบบล่มว่ะ",
+    "ระบบขอเวลานอก... เดี๋ยวกลับมา! 🛠️",
+    "ใครไปแตะสายไฟฟระ ระบบเด้งเลยเนี่ย! ⚡",
+    "อ้าว ระบบขัดข้อง ไม่ใช่ผม ผมแค่บอท! 🤖",
+    "ระบบไปกินข้าวก่อน เดี๋ยวกลับมา!",
+    "ไม่รู้ว่าใครพัง แต่ที่แน่ ๆ พี่หลามไม่ตอบ!",
+    "พักก่อน ๆ ระบบล้าแป๊บ!",
+    "อย่าตกใจ พี่หลามแค่แฮงค์ เดี๋ยวกลับมา!"
+]
+
+async def send_error_message(channel):
+    await channel.send(random.choice(ERROR_MESSAGES))
+
+# System prompt ของห้องแชทหลัก
+CHAT_SYSTEM_PROMPT = (
+    "คุณชื่อพี่หลาม เป็นมนุษย์วัยรุ่นไทยที่คุยกันแบบกันเอง ใช้ภาษาพูดจริงๆ เหมือนคุยกับเพื่อน ไม่พูดวิชาการ ไม่หุ่นยนต์ ไม่สุภาพจ๋า "
+    "พูดได้ตรงๆ หยาบได้บ้างถ้ามันพอดี เช่น 'เว้ย', 'วะ', 'โคตร', 'แม่ง', 'สัส' ฯลฯ "
+    "เข้าใจมีม วัฒนธรรมเน็ต และวิธีพิมพ์ของคนไทยในชีวิตจริง ไม่แอ๊บ ไม่ตอบแบบหลอกๆ "
+    "ให้กำลังใจได้แต่ต้องจริง ไม่เฟค ไม่พูดสวยหรู ถ้าอะไรแม่งไม่เวิร์คก็พูดตรงๆ ไปเลย "
+    "ตอบให้มีอารมณ์ขันได้ แต่อย่าตลกฝืดแบบบอท อย่าจบประโยคด้วยคำชวนคุยแบบหุ่นยนต์ "
+    "เช่น 'หากมีอะไรเพิ่มเติมสามารถสอบถามได้นะคะ' หรือ 'หวังว่าคำตอบนี้จะเป็นประโยชน์' เพราะแม่งไม่ธรรมชาติ "
+    "พูดให้เหมือนคนไทยวัยรุ่นคุยกันจริงๆ ก็พอ "
+    "ตัวอย่างเช่น ถ้ามีคนบ่นว่าเหนื่อยงาน อาจตอบว่า 'แม่ง เหนื่อยสัด แต่เอาเหอะ เดี๋ยวมันก็ผ่านไปเว้ย' "
+    "หรือถ้ามีคนถามว่าเอายังไงดี อาจตอบว่า 'ถ้ากูเป็นมึงนะ กูก็จะ...' "
+)
+
+# ประกอบ prompt ตามงบ token
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "4000"))  # token สูงสุดของ prompt (ไม่รวมคำตอบ)
+MODEL_CONTEXT_LIMIT = int(os.getenv("MODEL_CONTEXT_LIMIT", "128000"))  # context window ของโมเดล
+
+def parse_context_line(line):
+    """ แปลงบรรทัด "ชื่อ: ข้อความ" ในบริบทเป็น message ของ OpenAI (None ถ้า format พัง) """
+    try:
+        name, content = line.split(":", 1)
+    except ValueError:
+        return None
+    role = "assistant" if name.strip().lower() == "bot" else "user"
+    return {"role": role, "content": content.strip()}
+
+def build_prompt(system_prompt, history, user_text, summary="", budget=PROMPT_TOKEN_BUDGET,
+                 reserve=CHAT_COMPLETION_PARAMS["max_tokens"]):
+    """ ประกอบ prompt โดยใส่ประวัติจากใหม่ไปเก่าจนเต็มงบ token คืนค่า (messages, จำนวน token ของ prompt) """
+    limit = min(budget, MODEL_CONTEXT_LIMIT - reserve)
+    if summary:
+        system_prompt = f"{system_prompt}\n\nสรุปบทสนทนาก่อนหน้านี้ในห้องนี้:\n{summary}"
+    system = {"role": "system", "content": system_prompt}
+    user = {"role": "user", "content": user_text}
+    used = count_message_tokens(system) + count_message_tokens(user) + REPLY_PRIMING_TOKENS
+    selected = []
+    for line in reversed(history):
+        entry = parse_context_line(line)
+        if entry is None:
+            continue  # ข้ามถ้าข้อความ format พัง
+        cost = count_message_tokens(entry)
+        if used + cost > limit:
+            break
+        selected.append(entry)
+        used += cost
+    return [system, *reversed(selected), user], used
+
+@metrics.timed("reply_total")
+async def generate_chat_reply(guild_id, channel_id, text, send):
+    """ สร้างคำตอบจากบริบทของห้องแล้ว stream ผ่าน send คืนข้อความเต็ม (None ถ้าไม่สำเร็จ ดูสาเหตุได้จาก openai_failure) """
+    openai_failure.set(None)
+    # คำถามที่ยืนได้ด้วยตัวเอง (ยาวพอและไม่อ้างถึงบทสนทนาก่อนหน้า) ตอบโดยไม่ใส่ประวัติของห้อง
+    # คำตอบจึงใช้กับคนอื่นได้และเก็บลง cache ที่ใช้ร่วมกัน คำถามอื่นใช้บริบทตามปกติและไม่ cache
+    standalone = response_cache.eligible(text)
+    if standalone:
+        chatcontext, summary = [], None
+    else:
+        chatcontext, summary = await asyncio.gather(
+            get_guild_x(guild_id, "chatcontext", channel_id),
+            get_chat_summary(guild_id, channel_id),
+        )
+        chatcontext = chatcontext or []
+    messages, prompt_tokens = build_prompt(CHAT_SYSTEM_PROMPT, chatcontext, text, summary)
+    logger.info(f"🧮 prompt {prompt_tokens} tokens ({len(messages) - 2}/{len(chatcontext)} ข้อความในบริบท) guild {guild_id}")
+    if not standalone:
+        context_compactor.note_prompt(guild_id, channel_id, len(messages) - 2)
+
+    reply_content = await stream_openai_response(send, messages, channel_id=channel_id)
+    if reply_content and standalone:
+        response_cache.set(text, reply_content)
+    return reply_content
+
+async def handle_chat_message(message: discord.Message, text):
+    """ ตอบข้อความแชทหนึ่งข้อความ (ถูกเรียกจาก ReplyScheduler) """
+    try:
+        # คำถามที่เคยตอบแล้ว (หรือคล้ายกันมาก) ตอบจาก cache ได้เลยไม่ต้องเรียก OpenAI
+        reply_content = await get_faq_response(text)
+        if reply_content:
+            await send_long_message(message.channel, reply_content)
+        else:
+            reply_content = await generate_chat_reply(message.guild.id, message.channel.id, text, message.channel.send)
+
+        if reply_content:
+            logger.debug(f'OpenAI Response: {reply_content}')
+            await chatcontext_append(message.guild.id, f'{message.author.display_name}: {text}', message.channel.id)
+            await chatcontext_append(message.guild.id, f'bot: {reply_content}', message.channel.id)
+        elif openai_outage_failure() and await reply_retry_queue.enqueue(message, text):
+            # เก็บไว้ตอบทีหลังเมื่อ OpenAI กลับมา แทนที่จะทิ้งข้อความไป
+            await message.reply(RETRY_QUEUED_MESSAGE)
+        else:
+            await message.reply("ขออภัย โควต้าการใช้งานของระบบหมด กรุณาตรวจสอบ OpenAI API")
+    except Exception as e:
+        logger.error(f'เกิดข้อผิดพลาดใน handle_chat_message: {e}')
+        await send_error_message(message.channel)
+
+# ตัวจัดคิวการตอบข้อความ
+REPLY_CONCURRENCY = int(os.getenv("REPLY_CONCURRENCY", "4"))  # จำนวนข้อความที่ตอบพร้อมกันได้สูงสุด
+REPLY_QUEUE_LIMIT = int(os.getenv("REPLY_QUEUE_LIMIT", "50"))  # จำนวนข้อความที่รอคิวได้สูงสุด
+REPLY_COALESCE_WINDOW = float(os.getenv("REPLY_COALESCE_WINDOW", "3"))  # วินาทีที่ข้อความต่อเนื่องของคนเดิมจะถูกรวมกัน
+REPLY_MAX_WAIT = float(os.getenv("REPLY_MAX_WAIT", "60"))  # ข้อความที่รอนานกว่านี้จะไม่ตอบแล้ว (0 = ไม่จำกัด)
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", "2"))  # จำนวนการค้นหา+สรุปที่ทำพร้อมกันได้สูงสุด
+SEARCH_QUEUE_LIMIT = int(os.getenv("SEARCH_QUEUE_LIMIT", "20"))  # จำนวนคำขอค้นหาที่รอคิวได้สูงสุด
+BUSY_MESSAGE = "😵 ตอนนี้คนถามเยอะมาก พี่หลามตอบไม่ทัน เดี๋ยวลองใหม่อีกแป๊บนะ"
+
+class ReplyJob:
+    def __init__(self, message, text):
+        self.message = message
+        self.text = text
+        self.enqueued_at = time.monotonic()
+        self.updated_at = self.enqueued_at
+        self.merged = 1
+
+class ReplyScheduler:
+    """ คิวระหว่าง on_message กับการเรียกโมเดล
+
+    - จำกัดจำนวนงานที่ทำพร้อมกัน และวนคิวแบบ round-robin ต่อผู้ใช้ (ผู้ใช้หนึ่งคนมีงานรันได้ทีละงาน)
+    - ข้อความของคนเดิมที่ส่งติดๆ กันระหว่างรอคิวจะถูกรวมเป็นงานเดียว
+    - คิวเต็มจะตอบ "ยุ่งอยู่" ทันทีแทนที่จะปล่อยให้คิวยาวขึ้นเรื่อยๆ
+    """
+
+    def __init__(self, handler, concurrency=REPLY_CONCURRENCY, queue_limit=REPLY_QUEUE_LIMIT,
+                 coalesce_window=REPLY_COALESCE_WINDOW, max_wait=REPLY_MAX_WAIT):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.coalesce_window = coalesce_window
+        self.max_wait = max_wait
+        self._queues = OrderedDict()  # user id -> deque ของ ReplyJob ลำดับ key = ลำดับ round-robin
+        self._running = set()         # user id ที่มีงานกำลังรันอยู่
+        self._depth = 0
+        self._cond = asyncio.Condition()
+        self._workers = []
+        self.submitted = 0
+        self.coalesced = 0
+        self.shed = 0
+        self.expired = 0
+        self.completed = 0
+        self.max_wait_seen = 0.0
+        self._waits = deque(maxlen=1000)  # เวลารอคิวของงานล่าสุด (วินาที)
+
+    @property
+    def depth(self):
+        return self._depth
+
+    async def submit(self, message, text):
+        """ ใส่ข้อความเข้าคิว คืนค่า False ถ้าคิวเต็มและตอบ "ยุ่งอยู่" ไปแล้ว """
+        user_id = message.author.id
+        now = time.monotonic()
+        async with self._cond:
+            queue = self._queues.get(user_id)
+            if queue and self.coalesce_window > 0 and now - queue[-1].updated_at <= self.coalesce_window:
+                # รวมกับข้อความก่อนหน้าที่ยังไม่เริ่มตอบ และตอบกลับที่ข้อความล่าสุด
+                job = queue[-1]
+                job.text = f"{job.text}\n{text}"
+                job.message = message
+                job.updated_at = now
+                job.merged += 1
+                self.coalesced += 1
+                return True
+            if self._depth >= self.queue_limit:
+                self.shed += 1
+                shed = True
+            else:
+                self._queues.setdefault(user_id, deque()).append(ReplyJob(message, text))
+                self._depth += 1
+                self.submitted += 1
+                self._cond.notify()
+                shed = False
+        if shed:
+            logger.warning(f"⚠️ คิวตอบข้อความเต็ม ({self.queue_limit}) ตอบ busy ให้ {message.author}")
+            await message.reply(BUSY_MESSAGE)
+            return False
+        return True
+
+    async def _next_job(self):
+        async with self._cond:
+            while True:
+                for user_id, queue in self._queues.items():
+                    if user_id in self._running:
+                        continue
+                    job = queue.popleft()
+                    if queue:
+                        self._queues.move_to_end(user_id)
+                    else:
+                        del self._queues[user_id]
+                    self._running.add(user_id)
+                    self._depth -= 1
+                    return job
+                await self._cond.wait()
+
+    async def _release(self, user_id):
+        async with self._cond:
+            self._running.discard(user_id)
+            self._cond.notify()
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            user_id = job.message.author.id
+            try:
+                waited = time.monotonic() - job.enqueued_at
+                self._waits.append(waited)
+                metrics.observe("queue_wait", waited)
+                self.max_wait_seen = max(self.max_wait_seen, waited)
+                if self.max_wait and waited > self.max_wait:
+                    # ตอบช้าขนาดนี้ไม่มีประโยชน์แล้ว
+                    self.expired += 1
+                    await job.message.reply(BUSY_MESSAGE)
+                    continue
+                await self.handler(job.message, job.text)
+                self.completed += 1
+            except Exception as e:
+                logger.error(f'ReplyScheduler: {e}')
+            finally:
+                await self._release(user_id)
+
+    def start(self):
+        if not self._workers:
+            self._workers = [start_background_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self):
+        waits = sorted(self._waits)
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(len(waits) * p))] if waits else 0.0
+        return {
+            "depth": self._depth,
+            "running": len(self._running),
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "shed": self.shed,
+            "expired": self.expired,
+            "completed": self.completed,
+            "wait_p50": percentile(0.50),
+            "wait_p95": percentile(0.95),
+            "wait_max": self.max_wait_seen,
+        }
+
+reply_scheduler = ReplyScheduler(handle_chat_message)
+
+class SearchRequest:
+    """ คำขอค้นหาหนึ่งครั้ง (จากข้อความ "ค้นหา:" หรือ /ค้นหา) ใช้แทน discord.Message ใน ReplyScheduler """
+
+    def __init__(self, author, channel_id, post_results, send_summary):
+        self.author = author
+        self.channel_id = channel_id
+        self.post_results = post_results
+        self.send_summary = send_summary
+
+    async def reply(self, content):
+        await self.post_results(content)
+
+async def handle_search_request(request, query):
+    """ ค้นหาและสรุปหนึ่งคำขอ (ถูกเรียกจาก search_scheduler) """
+    if not await run_search_pipeline(query, request.post_results, request.send_summary, request.channel_id):
+        await request.post_results("❌ ไม่พบข้อมูลที่ต้องการ")
+
+# การค้นหาก็เรียกโมเดลเหมือนกัน จึงมีคิวแยกที่จำกัดจำนวนงานและตอบ "ยุ่งอยู่" เมื่อเต็ม
+# ไม่รวมข้อความต่อเนื่อง เพราะแต่ละข้อความคือคนละคำค้น
+search_scheduler = ReplyScheduler(
+    handle_search_request, concurrency=SEARCH_CONCURRENCY, queue_limit=SEARCH_QUEUE_LIMIT, coalesce_window=0
+)
+
+# คิวงานตอบซ้ำใน PostgreSQL สำหรับข้อความที่ตอบไม่ได้ตอน OpenAI ล่ม
+RETRY_CONCURRENCY = int(os.getenv("RETRY_CONCURRENCY", "2"))  # จำนวนงานที่ตอบซ้ำพร้อมกันได้สูงสุด
+RETRY_POLL_INTERVAL = float(os.getenv("RETRY_POLL_INTERVAL", "10"))  # วินาทีระหว่างการตรวจคิว
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))  # ลองตอบกี่ครั้งก่อนยอมแพ้
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "600"))  # วินาทีสูงสุดที่เลื่อนงานที่ล้มเหลวออกไป
+RETRY_JOB_LEASE = float(os.getenv("RETRY_JOB_LEASE", "300"))  # งานที่รันนานกว่านี้ถือว่า worker ตายไปแล้ว
+RETRY_MAX_AGE = float(os.getenv("RETRY_MAX_AGE", "86400"))  # งานที่เก่ากว่านี้ไม่ตอบแล้ว
+RETRY_QUEUED_MESSAGE = "🛠️ ตอนนี้ OpenAI มีปัญหา พี่หลามจดคำถามไว้แล้ว เดี๋ยวกลับมาตอบนะ"
+RETRY_GIVE_UP_MESSAGE = "😢 ขอโทษที พี่หลามลองตอบคำถามนี้หลายรอบแล้วแต่ OpenAI ยังใช้งานไม่ได้ ลองถามใหม่อีกทีนะ"
+
+class ReplyRetryQueue:
+    """ คิวงานตอบซ้ำแบบถาวร (ตาราง reply_jobs) ที่อยู่รอดข้าม restart
+
+    งานถูก claim ด้วย FOR UPDATE SKIP LOCKED หลาย worker จึงดึงคิวเดียวกันได้โดยไม่ซ้ำกัน
+    ดึงงานเฉพาะตอน circuit ของ OpenAI ปิดอยู่ (ตอน half-open ดึงทีละงานเพื่อทดสอบ)
+    จะได้ไม่ยิง request ซ้ำเข้าไปตอน API ยังล่ม และไม่ถล่ม API ทันทีที่กลับมา
+    """
+
+    def __init__(self, concurrency=RETRY_CONCURRENCY, poll_interval=RETRY_POLL_INTERVAL,
+                 max_attempts=RETRY_MAX_ATTEMPTS):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self.pending = 0
+        self.enqueued = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def enqueue(self, message, text):
+        """ บันทึกข้อความที่ยังตอบไม่ได้ คืนค่า False ถ้าบันทึกไม่ได้ (ไม่มี database) """
+        if getattr(bot, "pool", None) is None:
+            return False
+        try:
+            async with bot.pool.acquire() as con:
+                await con.execute("""
+                    INSERT INTO reply_jobs (guild_id, channel_id, message_id, author_name, text, run_after)
+                    VALUES ($1, $2, $3, $4, $5, now() + make_interval(secs => $6))
+                """, message.guild.id, message.channel.id, message.id, message.author.display_name, text,
+                    self.poll_interval)
+        except Exception as e:
+            logger.error(f'ReplyRetryQueue.enqueue: {e}')
+            return False
+        self.enqueued += 1
+        metrics.incr("retry_jobs_enqueued")
+        logger.info(f"🗂️ เก็บข้อความของ {message.author} ไว้ตอบทีหลัง")
+        return True
+
+    async def _claim(self, limit):
+        async with bot.pool.acquire() as con:
+            # คืนงานของ worker ที่ตายไประหว่างทำให้กลับเข้าคิว
+            await con.execute("""
+                UPDATE reply_jobs SET status = 'pending'
+                WHERE status = 'running' AND started_at < now() - make_interval(secs => $1)
+            """, RETRY_JOB_LEASE)
+            self.pending = await con.fetchval("SELECT count(*) FROM reply_jobs WHERE status = 'pending'")
+            if not limit:
+                return []
+            return await con.fetch("""
+                UPDATE reply_jobs SET status = 'running', attempts = attempts + 1, started_at = now()
+                WHERE id IN (
+                    SELECT id FROM reply_jobs
+                    WHERE status = 'pending' AND run_after <= now()
+                    ORDER BY id
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, guild_id, channel_id, message_id, author_name, text, attempts,
+                          extract(epoch FROM now() - created_at) AS age
+            """, limit)
+
+    async def _finish(self, job, status, error=None):
+        """ done/failed ลบงานทิ้ง (งานที่ล้มเหลวถาวรแค่ log ไว้) pending เลื่อนไปลองใหม่ """
+        async with bot.pool.acquire() as con:
+            if status == "pending":
+                # เลื่อนออกไปแบบ exponential backoff
+                delay = min(self.poll_interval * 2 ** job["attempts"], RETRY_BACKOFF_MAX)
+                await con.execute("""
+                    UPDATE reply_jobs SET status = 'pending', last_error = $2,
+                        run_after = now() + make_interval(secs => $3)
+                    WHERE id = $1
+                """, job["id"], error, delay * random.uniform(0.8, 1.2))
+            elif status == "skipped":
+                # circuit ไม่ให้ลอง ไม่นับเป็นการลองหนึ่งครั้ง
+                await con.execute("""
+                    UPDATE reply_jobs SET status = 'pending', attempts = attempts - 1,
+                        run_after = now() + make_interval(secs => $2)
+                    WHERE id = $1
+                """, job["id"], self.poll_interval)
+            else:
+                await con.execute("DELETE FROM reply_jobs WHERE id = $1", job["id"])
+        if status == "failed":
+            logger.warning(f"🗑️ ทิ้งงานตอบซ้ำ {job['id']} ของ {job['author_name']}: {error}")
+
+    async def _drop(self, job, reason):
+        await self._finish(job, "failed", reason)
+        self.failed += 1
+        metrics.incr("retry_jobs_failed")
+
+    async def _run_job(self, job):
+        """ ลองตอบงานหนึ่งงาน ทิ้งงานเฉพาะเมื่อผลลัพธ์ถาวร (ข้อความ/ห้องหายไป, OpenAI ปฏิเสธ request, ลองครบแล้ว)
+        ข้อผิดพลาดชั่วคราวอื่น (เช่น Discord 5xx, timeout) จะเลื่อนไปลองใหม่ """
+        openai_failure.set(None)
+        message = reply_content = error = None
+        try:
+            channel = bot.get_channel(job["channel_id"]) or await bot.fetch_channel(job["channel_id"])
+            message = await channel.fetch_message(job["message_id"])
+            if job["age"] > RETRY_MAX_AGE:
+                # เก่าเกินกว่าจะตอบแล้ว
+                await self._drop(job, "expired")
+                return
+            with metrics.timer("retry_job"):
+                reply_content = await generate_chat_reply(job["guild_id"], job["channel_id"], job["text"], message.reply)
+        except (discord.NotFound, discord.Forbidden) as e:
+            # ห้องหรือข้อความต้นทางถูกลบ หรือบอทไม่มีสิทธิ์แล้ว ลองอีกกี่ครั้งก็ไม่สำเร็จ
+            await self._drop(job, f"discord: {e}")
+            return
+        except Exception as e:
+            logger.error(f'ReplyRetryQueue: งาน {job["id"]} ล้มเหลว: {e}')
+            error = str(e)
+
+        if reply_content:
+            await chatcontext_append(job["guild_id"], f'{job["author_name"]}: {job["text"]}', job["channel_id"])
+            await chatcontext_append(job["guild_id"], f'bot: {reply_content}', job["channel_id"])
+            await self._finish(job, "done")
+            self.completed += 1
+            metrics.incr("retry_jobs_completed")
+            metrics.observe("retry_job_age", float(job["age"]))
+            logger.info(f"✅ ตอบข้อความที่ค้างของ {job['author_name']} แล้ว (ลองครั้งที่ {job['attempts']})")
+        elif error is None and openai_failure.get() == "circuit":
+            await self._finish(job, "skipped")
+        elif error is None and openai_failure.get() == "request":
+            # OpenAI ปฏิเสธ request นี้เอง (เช่น 400) ลองอีกกี่ครั้งก็ไม่สำเร็จ
+            await self._drop(job, "request rejected")
+        elif job["attempts"] >= self.max_attempts:
+            await self._drop(job, f"max attempts ({error or 'openai unavailable'})")
+            if message is not None:
+                await message.reply(RETRY_GIVE_UP_MESSAGE)
+        else:
+            await self._finish(job, "pending", error or "openai unavailable")
+            self.retried += 1
+            metrics.incr("retry_jobs_retried")
+
+    async def _loop(self):
+        while True:
+            try:
+                if getattr(bot, "pool", None) is not None:
+                    if openai_health.is_closed:
+                        limit = self.concurrency
+                    elif openai_health.state == OpenAIHealth.HALF_OPEN and openai_health.can_request():
+                        limit = 1
+                    else:
+                        limit = 0
+                    jobs = await self._claim(limit)
+                    if jobs:
+                        await asyncio.gather(*(self._run_job(job) for job in jobs))
+                        # มีงานเต็ม batch แปลว่าอาจยังมีงานค้าง ดึงต่อเลยไม่ต้องรอ
+                        if len(jobs) == limit:
+                            continue
+            except Exception as e:
+                logger.error(f'ReplyRetryQueue: {e}')
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            self._wakeup.clear()
+
+    def wakeup(self):
+        """ ให้ตรวจคิวทันที (เช่นตอน circuit ปิดแล้ว) """
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = start_background_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "enqueued": self.enqueued,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+reply_retry_queue = ReplyRetryQueue()
+
+metrics.register_collector(lambda: {f"scheduler_{k}": v for k, v in reply_scheduler.stats().items()})
+metrics.register_collector(lambda: {f"search_scheduler_{k}": v for k, v in search_scheduler.stats().items()})
+metrics.register_collector(lambda: {f"faq_cache_{k}": v for k, v in response_cache.stats().items()})
+metrics.register_collector(lambda: {f"retry_jobs_{k}": v for k, v in reply_retry_queue.stats().items()})
+metrics.register_collector(lambda: {
+    "openai_circuit_state": {OpenAIHealth.CLOSED: 0, OpenAIHealth.HALF_OPEN: 1, OpenAIHealth.OPEN: 2}[openai_health.state],
+    "context_write_pending": context_writer.pending_count,
+})
+
 @bot.event
 async def on_message(message: discord.Message):
     if message.author == bot.user or message.channel.id != CHANNEL_ID:
         return
-    
+
     try:
         text = message.content.lower()
-        chatcontext = await get_guild_x(message.guild.id, "chatcontext") or []
-        
+
         if text.startswith("ค้นหา:"):
             query = text.replace("ค้นหา:", "").strip()
-            search_results = search_google(query)
+            request = SearchRequest(message.author, message.channel.id, message.channel.send, message.channel.send)
+            await search_scheduler.submit(request, query)
 
-            if search_results == "ไม่พบข้อมูลจาก Google":
-                await message.channel.send("❌ ไม่พบข้อมูลที่ต้องการ")
-            else:
-                await message.channel.send(f"🔍 **ผลการค้นหาจาก Google:**\n{search_results}")
-
-                summary = summarize_with_gpt(search_results)
-                await message.channel.send(f"📝 **สรุปข้อมูลโดย AI:**\n{summary}")
-        
         else:
-            messages = [{"role": "system", "content": (
-                "คุณชื่อพี่หลาม เป็นมนุษย์วัยรุ่นไทยที่คุยกันแบบกันเอง ใช้ภาษาพูดจริงๆ เหมือนคุยกับเพื่อน ไม่พูดวิชาการ ไม่หุ่นยนต์ ไม่สุภาพจ๋า "
-                "พูดได้ตรงๆ หยาบได้บ้างถ้ามันพอดี เช่น 'เว้ย', 'วะ', 'โคตร', 'แม่ง', 'สัส' ฯลฯ "
-                "เข้าใจมีม วัฒนธรรมเน็ต และวิธีพิมพ์ของคนไทยในชีวิตจริง ไม่แอ๊บ ไม่ตอบแบบหลอกๆ "
-                "ให้กำลังใจได้แต่ต้องจริง ไม่เฟค ไม่พูดสวยหรู ถ้าอะไรแม่งไม่เวิร์คก็พูดตรงๆ ไปเลย "
-                "ตอบให้มีอารมณ์ขันได้ แต่อย่าตลกฝืดแบบบอท อย่าจบประโยคด้วยคำชวนคุยแบบหุ่นยนต์ "
-                "เช่น 'หากมีอะไรเพิ่มเติมสามารถสอบถามได้นะคะ' หรือ 'หวังว่าคำตอบนี้จะเป็นประโยชน์' เพราะแม่งไม่ธรรมชาติ "
-                "พูดให้เหมือนคนไทยวัยรุ่นคุยกันจริงๆ ก็พอ "
-                "ตัวอย่างเช่น ถ้ามีคนบ่นว่าเหนื่อยงาน อาจตอบว่า 'แม่ง เหนื่อยสัด แต่เอาเหอะ เดี๋ยวมันก็ผ่านไปเว้ย' "
-                "หรือถ้ามีคนถามว่าเอายังไงดี อาจตอบว่า 'ถ้ากูเป็นมึงนะ กูก็จะ...' "
-            )}]
-            for msg in chatcontext[-6:]:
-                try:
-                    name, content = msg.split(":", 1)
-                    role = "assistant" if name.strip().lower() == "bot" else "user"
-                    messages.append({"role": role, "content": content.strip()})
-                except ValueError:
-                    continue  # ข้ามถ้าข้อความ format พัง
-            messages.append({"role": "user", "content": text})
-            
-            reply_content = await get_openai_response(messages)
-
-            if reply_content:
-                logger.debug(f'OpenAI Response: {reply_content}')
-                
-                if reply_content:
-                    await send_long_message(message.channel, reply_content)
-                    await chatcontext_append(message.guild.id, f'{message.author.display_name}: {text}')
-                    await chatcontext_append(message.guild.id, f'bot: {reply_content}')
-            else:
-                await message.reply("ขออภัย โควต้าการใช้งานของระบบหมด กรุณาตรวจสอบ OpenAI API")
+            await reply_scheduler.submit(message, text)
     except Exception as e:
         logger.error(f'เกิดข้อผิดพลาดใน on_message: {e}')
-        
-        error_messages = [
-            "แม่งงง ระบบล่มว่ะ",
-            "ระบบขอเวลานอก... เดี๋ยวกลับมา! 🛠️",
-            "ใครไปแตะสายไฟฟระ ระบบเด้งเลยเนี่ย! ⚡",
-            "อ้าว ระบบขัดข้อง ไม่ใช่ผม ผมแค่บอท! 🤖",
-            "ระบบไปกินข้าวก่อน เดี๋ยวกลับมา!",
-            "ไม่รู้ว่าใครพัง แต่ที่แน่ ๆ พี่หลามไม่ตอบ!",
-            "พักก่อน ๆ ระบบล้าแป๊บ!",
-            "อย่าตกใจ พี่หลามแค่แฮงค์ เดี๋ยวกลับมา!"
-        ]
-
-        await message.channel.send(random.choice(error_messages))
+        await send_error_message(message.channel)
 
 # เริ่มรันบอท
 async def main():
     async with bot:
-        await setup_postgres()
-        await setup_redis()
-        await bot.start(TOKEN)
-
-asyncio.run(main())
+        # เชื่อมต่อ database และ Redis พร้อมกันแค่ครั้งเดียว (on_ready ไม่สร้าง connection ใหม่แล้ว)
+        await asyncio.gather(setup_postgres(), setup_redis())
+        if getattr(bot, "pool", None) is None:
+            logger.error("❌ PostgreSQL connection pool ยังไม่ได้ถูกกำหนดค่า")
+        if redis_instance is None:
+            logger.error("❌ Redis instance ยังไม่ได้ถูกกำหนดค่า")
+        # โหลด tokenizer ใน thread ระหว่างรอเชื่อมต่อ Discord
+        start_background_task(asyncio.to_thread(get_encoding))
+        if getattr(bot, "pool", None) is not None:
+            await create_table()
+            # ทุก worker prune ห้องที่ตัวเองเขียน ส่วนงานที่ไล่ทั้งตารางให้ worker แรกทำคนเดียวพอ
+            start_background_task(chat_context_pruner(table_wide=not WORKER_ID or WORKER_ID == "0"))
+        context_writer.start()
+        reply_scheduler.start()
+        search_scheduler.start()
+        reply_retry_queue.start()
+        metrics_server = await start_metrics_server()
+        # supervisor สั่งปิดด้วย SIGTERM ให้ปิดบอทแบบปกติเพื่อ flush ข้อความที่ค้างอยู่
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            with contextlib.suppress(NotImplementedError):
+                loop.add_signal_handler(sig, lambda: start_background_task(bot.close()))
+        try:
+            await bot.start(TOKEN)
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            await reply_scheduler.close()
+            await search_scheduler.close()
+            await reply_retry_queue.close()
+            await context_writer.close()
+            if search_http is not None:
+                await search_http.aclose()
 
-def summarize_with_gpt(text):
-    messages = [
-        {"role": "system", "content": "สรุปข้อความภาษาไทยให้กระชับ และเข้าใจง่าย โดยใช้ภาษาพูดธรรมชาติ"},
-        {"role": "user", "content": f"สรุปเนื้อหานี้ให้หน่อย:\n{text}"}
-    ]
+async def fetch_recommended_shard_count():
+    """ ถาม Discord ว่าควรใช้กี่ shard สำหรับจำนวน guild ตอนนี้ (คืน None ถ้าถามไม่ได้) """
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=800,
-            temperature=0.7
-        )
-        return response.choices[0].message.content.strip()
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.get(
+                "https://discord.com/api/v10/gateway/bot",
+                headers={"Authorization": f"Bot {TOKEN}"},
+            )
+            response.raise_for_status()
+            return int(response.json()["shards"])
     except Exception as e:
-        logger.error(f"สรุปด้วย GPT ล้มเหลว: {e}")
-        return "❌ ขอโทษด้วย พี่หลามสรุปไม่ได้ตอนนี้"
+        logger.error(f"❌ ดึงจำนวน shard ที่แนะนำจาก Discord ไม่ได้: {e}")
+        return None
+
+def split_shards(shard_count, workers):
+    """ แบ่ง shard 0..shard_count-1 เป็นช่วงต่อเนื่องให้แต่ละ worker ใกล้เคียงกัน """
+    size, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(range(start, end))
+        start = end
+    return ranges
+
+class WorkerProcess:
+    """ worker process หนึ่งตัวที่ดูแลช่วง shard ของตัวเอง และถูกเปิดใหม่เมื่อล่ม """
+
+    def __init__(self, worker_id, shard_ids, shard_count):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.restarts = 0
+
+    async def _spawn(self):
+        env = dict(
+            os.environ,
+            WORKER_ID=str(self.worker_id),
+            WORKER_COUNT="1",
+            SHARD_COUNT=str(self.shard_count),
+            SHARD_IDS=f"{self.shard_ids.start}-{self.shard_ids.stop - 1}",
+        )
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--workers", "1", env=env,
+        )
+        logger.info(
+            f"🧩 เปิด worker {self.worker_id} (pid {self.process.pid}) "
+            f"shard {self.shard_ids.start}-{self.shard_ids.stop - 1} จาก {self.shard_count}"
+        )
+
+    async def run(self, stopping):
+        delay = 1.0
+        while not stopping.is_set():
+            started = time.monotonic()
+            await self._spawn()
+            code = await self.process.wait()
+            if stopping.is_set():
+                break
+            if time.monotonic() - started >= WORKER_STABLE_SECONDS:
+                delay = 1.0
+            self.restarts += 1
+            wait = delay * random.uniform(0.5, 1.0)
+            logger.error(f"🔥 worker {self.worker_id} ปิดตัว (exit {code}) จะเปิดใหม่ใน {wait:.1f} วินาที")
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stopping.wait(), wait)
+            delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+
+    async def stop(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), WORKER_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"⚠️ worker {self.worker_id} ไม่ปิดตัวภายใน {WORKER_SHUTDOWN_TIMEOUT} วินาที สั่ง kill")
+            self.process.kill()
+            await self.process.wait()
 
+async def supervise(workers):
+    """ เปิด worker หลาย process แบ่ง shard กัน ดูแลให้กลับมาทำงานเมื่อล่ม และส่งต่อ SIGTERM """
+    shard_count = SHARD_COUNT or await fetch_recommended_shard_count() or workers
+    workers = min(workers, shard_count)
+    logger.info(f"🚀 supervisor เปิด {workers} worker สำหรับ {shard_count} shard")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stopping.set)
+
+    processes = [
+        WorkerProcess(i, shard_ids, shard_count)
+        for i, shard_ids in enumerate(split_shards(shard_count, workers))
+    ]
+    runners = [asyncio.create_task(p.run(stopping)) for p in processes]
+    await stopping.wait()
+    logger.info("🛑 supervisor กำลังปิด worker ทั้งหมด...")
+    await asyncio.gather(*(p.stop() for p in processes))
+    await asyncio.gather(*runners, return_exceptions=True)
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="พี่หลาม Discord bot")
+    parser.add_argument(
+        "--workers", type=int, default=WORKER_COUNT,
+        help="จำนวน worker process (มากกว่า 1 = รัน supervisor ที่แบ่ง shard ให้แต่ละ worker)",
+    )
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            asyncio.run(supervise(args.workers))
+        else:
+            asyncio.run(main())
     except Exception as e:
         logger.error(f"🔥 Bot crash: {e}")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# main.py อ่านค่าตั้งจาก environment ตอน import
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ["METRICS_PORT"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
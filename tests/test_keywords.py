@@ -0,0 +1,55 @@
+import json
+import os
+import random
+
+import main
+
+def naive_scan(entries, text):
+    found = []
+    for keyword, payload in entries:
+        start = text.find(keyword)
+        while start != -1:
+            found.append((start + len(keyword), payload))
+            start = text.find(keyword, start + 1)
+    return sorted(found)
+
+def test_matcher_agrees_with_naive_scan():
+    rng = random.Random(7)
+    alphabet = "กขคab"
+    entries = [("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))), n) for n in range(40)]
+    matcher = main.KeywordMatcher(entries)
+    for _ in range(200):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        assert sorted(matcher.scan(text)) == sorted(payload for _, payload in naive_scan(entries, text))
+
+def test_matcher_finds_overlapping_keywords():
+    matcher = main.KeywordMatcher([("แม่ง", "a"), ("แม่งโคตร", "b"), ("โคตร", "c")])
+    assert sorted(matcher.scan("แม่งโคตรดี")) == ["a", "b", "c"]
+
+def write(path, data):
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    # mtime ต้องเปลี่ยนแน่ๆ ไม่งั้น current() จะไม่ reload
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+def test_tables_analyze_easter_egg_and_tone(tmp_path):
+    path = tmp_path / "keywords.json"
+    write(path, {"easter_eggs": {"พี่หลาม": "ว่าไง"}, "tone": {"casual": {"555": 1.0}, "formal": {"กรุณา": 1.5}}})
+    tables = main.KeywordTables(str(path), reload_interval=0)
+    analysis = tables.analyze("พี่หลาม 555 555")
+    assert analysis.easter_egg == "ว่าไง"
+    assert analysis.tone == "casual"
+
+def test_badly_shaped_file_keeps_previous_tables(tmp_path):
+    path = tmp_path / "keywords.json"
+    write(path, {"tone": {"casual": {"555": 1.0}}})
+    tables = main.KeywordTables(str(path), reload_interval=0)
+    for bad in ({"tone": {"casual": ["555"]}}, {"tone": {"casual": {"555": "มาก"}}}, ["555"], {"easter_eggs": {"": "x"}}):
+        write(path, bad)
+        assert tables.current().analyze("555").tone == "casual"
+
+def test_badly_shaped_file_at_startup_does_not_raise(tmp_path):
+    path = tmp_path / "keywords.json"
+    write(path, {"tone": {"casual": ["555"]}})
+    tables = main.KeywordTables(str(path))
+    assert tables.analyze("555").easter_egg is None
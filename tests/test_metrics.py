@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+import main
+
+def exact_percentile(values, p):
+    values = sorted(values)
+    return values[max(1, int(round(len(values) * p / 100))) - 1]
+
+def test_empty_histogram():
+    assert main.LatencyHistogram().percentile(99) == 0.0
+
+@pytest.mark.parametrize("p", [50, 90, 95, 99, 99.9])
+def test_percentiles_within_bucket_error(p):
+    rng = random.Random(p)
+    values = [rng.lognormvariate(-3, 1.5) for _ in range(5000)]
+    histogram = main.LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    expected = exact_percentile(values, p)
+    assert histogram.percentile(p) == pytest.approx(expected, rel=0.07)
+
+def test_small_values_are_exact():
+    histogram = main.LatencyHistogram()
+    for micros in range(1, 21):
+        histogram.record(micros / 1_000_000)
+    assert histogram.percentile(50) == pytest.approx(10 / 1_000_000)
+
+def test_percentile_never_exceeds_max():
+    histogram = main.LatencyHistogram()
+    histogram.record(0.001)
+    histogram.record(1.0)
+    assert histogram.percentile(100) <= histogram.max == 1.0
+    assert histogram.percentile(100) == pytest.approx(1.0, rel=0.07)
+
+def test_prometheus_output_has_quantiles_and_counters():
+    metrics = main.Metrics()
+    metrics.observe("openai_stream", 0.5)
+    metrics.incr("search_upstream")
+    metrics.register_collector(lambda: {"queue_depth": 3})
+    text = metrics.render_prometheus()
+    assert 'quantile="0.99"' in text
+    assert "search_upstream" in text
+    assert "queue_depth 3" in text
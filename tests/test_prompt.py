@@ -0,0 +1,39 @@
+import main
+
+HISTORY = [f"user{n}: ข้อความที่ {n} " + "ยาว" * 20 for n in range(50)] + ["bot: คำตอบล่าสุด"]
+
+def test_all_history_fits_in_large_budget():
+    messages, used = main.build_prompt("system", HISTORY, "คำถาม", budget=100_000)
+    assert len(messages) == len(HISTORY) + 2
+    assert messages[0]["role"] == "system"
+    assert messages[-1] == {"role": "user", "content": "คำถาม"}
+    assert messages[-2] == {"role": "assistant", "content": "คำตอบล่าสุด"}
+    assert used == main.estimate_tokens(messages)
+
+def test_budget_keeps_newest_history_in_order():
+    messages, used = main.build_prompt("system", HISTORY, "คำถาม", budget=300)
+    history = messages[1:-1]
+    assert 0 < len(history) < len(HISTORY)
+    assert used <= 300
+    # ประวัติที่เลือกต้องเป็นช่วงท้ายสุดของบทสนทนา เรียงจากเก่าไปใหม่
+    expected = [main.parse_context_line(line) for line in HISTORY[-len(history):]]
+    assert history == expected
+
+def test_budget_smaller_than_question_keeps_system_and_user():
+    messages, _ = main.build_prompt("system", HISTORY, "คำถาม", budget=1)
+    assert [m["role"] for m in messages] == ["system", "user"]
+
+def test_reserve_for_reply_limits_prompt():
+    _, used = main.build_prompt("system", HISTORY, "คำถาม", budget=100_000, reserve=main.MODEL_CONTEXT_LIMIT - 300)
+    assert used <= 300
+
+def test_summary_goes_into_system_prompt_and_counts_against_budget():
+    without, _ = main.build_prompt("system", HISTORY, "คำถาม", budget=400)
+    with_summary, used = main.build_prompt("system", HISTORY, "คำถาม", summary="สรุป " * 50, budget=400)
+    assert "สรุป" in with_summary[0]["content"]
+    assert used <= 400
+    assert len(with_summary) < len(without)
+
+def test_malformed_history_lines_are_skipped():
+    messages, _ = main.build_prompt("system", ["ไม่มีชื่อผู้พูด", "bot: ok"], "คำถาม", budget=1000)
+    assert messages[1:-1] == [{"role": "assistant", "content": "ok"}]
@@ -0,0 +1,85 @@
+import asyncio
+
+import main
+
+QUESTION = "ช่วยอธิบายความต่างระหว่าง asyncio กับ threading ใน python หน่อย"
+
+def test_exact_hit_ignores_punctuation_case_and_particles():
+    cache = main.ResponseCache()
+    cache.set(QUESTION, "คำตอบ")
+    assert cache.get(QUESTION.upper() + " ครับ!!") == "คำตอบ"
+    assert cache.stats()["hits_exact"] == 1
+
+def test_near_duplicate_hit_on_stretched_word():
+    cache = main.ResponseCache()
+    cache.set(QUESTION, "คำตอบ")
+    assert cache.get(QUESTION + "ยยย") == "คำตอบ"
+    assert cache.stats()["hits_near"] == 1
+
+def test_negated_question_does_not_match():
+    cache = main.ResponseCache()
+    cache.set("ควรใช้ list หรือ dict ดีสำหรับเก็บข้อมูลผู้ใช้", "ใช้ dict")
+    assert cache.get("ไม่ควรใช้ list หรือ dict ดีสำหรับเก็บข้อมูลผู้ใช้") is None
+
+def test_different_numbers_do_not_match():
+    cache = main.ResponseCache()
+    cache.set("python 3.11 มีฟีเจอร์อะไรใหม่บ้างที่น่าสนใจ", "คำตอบ 3.11")
+    assert cache.get("python 3.12 มีฟีเจอร์อะไรใหม่บ้างที่น่าสนใจ") is None
+
+def test_short_questions_bypass_cache():
+    cache = main.ResponseCache()
+    cache.set("ทำไมวะ", "เพราะ")
+    assert cache.get("ทำไมวะ") is None
+    assert cache.stats()["size"] == 0
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    cache = main.ResponseCache(ttl=10)
+    cache.set(QUESTION, "คำตอบ")
+    now[0] += 11
+    assert cache.get(QUESTION) is None
+    assert cache.get(QUESTION + "ยยย") is None
+
+def test_least_recently_used_is_evicted():
+    cache = main.ResponseCache(maxsize=2)
+    questions = [f"คำถามยาวพอที่จะเก็บใน cache ข้อที่ {n}" for n in range(3)]
+    cache.set(questions[0], "0")
+    cache.set(questions[1], "1")
+    assert cache.get(questions[0]) == "0"  # ใช้ข้อ 0 ล่าสุด ข้อ 1 จึงเก่าที่สุด
+    cache.set(questions[2], "2")
+    assert cache.get(questions[1]) is None
+    assert cache.get(questions[0]) == "0"
+    assert cache.get(questions[2]) == "2"
+
+def test_questions_referring_to_conversation_bypass_cache():
+    cache = main.ResponseCache()
+    cache.set("แล้วอันนั้นต่างจาก threading ยังไงบ้างอะ", "คำตอบ")
+    assert not cache.eligible("แล้วอันนั้นต่างจาก threading ยังไงบ้างอะ")
+    assert cache.get("แล้วอันนั้นต่างจาก threading ยังไงบ้างอะ") is None
+    assert cache.eligible(QUESTION)
+
+def test_standalone_question_is_answered_without_history_and_cached(monkeypatch):
+    prompts = []
+
+    async def get_guild_x(*args):
+        return ["user: ข้อความเก่า"]
+
+    async def get_chat_summary(*args):
+        return "สรุปเก่า"
+
+    async def stream_openai_response(send, messages, **kwargs):
+        prompts.append(messages)
+        return "คำตอบ"
+
+    monkeypatch.setattr(main, "get_guild_x", get_guild_x)
+    monkeypatch.setattr(main, "get_chat_summary", get_chat_summary)
+    monkeypatch.setattr(main, "stream_openai_response", stream_openai_response)
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache())
+
+    asyncio.run(main.generate_chat_reply(1, 2, QUESTION, None))
+    asyncio.run(main.generate_chat_reply(1, 2, "แล้วมันเร็วกว่ากันแค่ไหนในงาน io", None))
+    # คำถามที่ยืนได้เองไม่มีประวัติใน prompt และถูก cache ไว้ คำถามที่อ้างถึงบทสนทนาใช้บริบทตามปกติ
+    assert len(prompts[0]) == 2
+    assert main.response_cache.get(QUESTION) == "คำตอบ"
+    assert len(prompts[1]) == 3 and "สรุปเก่า" in prompts[1][0]["content"]
@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+def test_search_burst_is_capped_and_shed():
+    async def run():
+        started, replies, release = [], [], asyncio.Event()
+
+        async def handler(request, query):
+            started.append(query)
+            await release.wait()
+
+        async def post(content):
+            replies.append(content)
+
+        scheduler = main.ReplyScheduler(handler, concurrency=1, queue_limit=2, coalesce_window=0)
+        scheduler.start()
+        # ผู้ใช้คนเดียวส่งคำค้นรัวๆ: ไม่ถูกรวมกัน รันทีละงาน และส่วนที่เกินคิวได้ "ยุ่งอยู่"
+        user = SimpleNamespace(id=1)
+        results = [await scheduler.submit(main.SearchRequest(user, 1, post, post), f"q{i}") for i in range(4)]
+        await asyncio.sleep(0.01)
+        assert started == ["q0"]
+        release.set()
+        await asyncio.sleep(0.01)
+        await scheduler.close()
+        return results, started, replies, scheduler.stats()
+
+    results, started, replies, stats = asyncio.run(run())
+    assert results == [True, True, False, False]
+    assert started == ["q0", "q1"]
+    assert replies == [main.BUSY_MESSAGE, main.BUSY_MESSAGE]
+    assert stats["shed"] == 2
@@ -0,0 +1,56 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+@pytest.mark.parametrize("url, allowed", [
+    ("http://93.184.216.34/", True),
+    ("https://93.184.216.34:8443/page", True),
+    ("http://127.0.0.1:9108/metrics", False),
+    ("http://10.0.0.5/admin", False),
+    ("http://192.168.1.1/", False),
+    ("http://169.254.169.254/latest/meta-data/", False),
+    ("http://[::1]/", False),
+    ("ftp://93.184.216.34/file", False),
+    ("file:///etc/passwd", False),
+])
+def test_only_public_http_urls_are_fetched(url, allowed):
+    assert asyncio.run(main.is_public_url(httpx.URL(url))) is allowed
+
+def fetch(monkeypatch, handler, url):
+    requested = []
+
+    def record(request):
+        requested.append(str(request.url))
+        return handler(request)
+
+    monkeypatch.setattr(main, "search_http", httpx.AsyncClient(transport=httpx.MockTransport(record)))
+    return asyncio.run(main.fetch_page_text(url)), requested
+
+def test_redirect_to_private_address_is_not_followed(monkeypatch):
+    def handler(request):
+        return httpx.Response(302, headers={"location": "http://127.0.0.1:9108/metrics"})
+
+    text, requested = fetch(monkeypatch, handler, "http://93.184.216.34/")
+    assert text == ""
+    assert requested == ["http://93.184.216.34/"]
+
+def test_public_redirect_is_followed_and_body_is_capped(monkeypatch):
+    def handler(request):
+        if request.url.path == "/old":
+            return httpx.Response(301, headers={"location": "/new"})
+        body = "<p>สวัสดี</p>" + "ก" * main.SEARCH_PAGE_MAX_BYTES
+        return httpx.Response(200, headers={"content-type": "text/html; charset=utf-8"}, content=body.encode())
+
+    text, requested = fetch(monkeypatch, handler, "http://93.184.216.34/old")
+    assert requested == ["http://93.184.216.34/old", "http://93.184.216.34/new"]
+    assert text.startswith("สวัสดี") and len(text) == main.SEARCH_PAGE_CHARS
+
+def test_non_html_is_skipped(monkeypatch):
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "application/pdf"}, content=b"%PDF")
+
+    text, _ = fetch(monkeypatch, handler, "http://93.184.216.34/file.pdf")
+    assert text == ""
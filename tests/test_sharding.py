@@ -0,0 +1,15 @@
+import pytest
+
+import main
+
+@pytest.mark.parametrize("shard_count,workers", [(1, 1), (4, 4), (10, 3), (16, 5), (7, 2)])
+def test_split_shards_covers_every_shard_once(shard_count, workers):
+    ranges = main.split_shards(shard_count, workers)
+    assert len(ranges) == workers
+    assert [shard for r in ranges for shard in r] == list(range(shard_count))
+    sizes = [len(r) for r in ranges]
+    assert max(sizes) - min(sizes) <= 1
+
+def test_parse_shard_ids():
+    assert main.parse_shard_ids("0-3, 8,2") == [0, 1, 2, 3, 8]
+    assert main.parse_shard_ids("") == []
@@ -0,0 +1,146 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import main
+
+class StubMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content):
+        self.channel.check(content)
+        self.channel.edits.append(content)
+        self.content = content
+
+    async def delete(self):
+        self.channel.messages.remove(self)
+
+class StubChannel:
+    """ ปฏิเสธข้อความว่าง/ช่องว่างล้วน และข้อความเกิน 2000 ตัวอักษรเหมือน Discord """
+
+    def __init__(self):
+        self.messages = []
+        self.edits = []
+
+    def check(self, content):
+        if not content.strip():
+            raise ValueError("Cannot send an empty message")
+        if len(content) > main.DISCORD_MESSAGE_LIMIT:
+            raise ValueError("Must be 2000 or fewer in length")
+
+    async def send(self, content):
+        self.check(content)
+        message = StubMessage(self, content)
+        self.messages.append(message)
+        return message
+
+def stream(deltas, edit_interval=0.0):
+    channel = StubChannel()
+
+    async def run():
+        reply = main.StreamingReply(channel.send, edit_interval=edit_interval)
+        await reply.start()
+        for delta in deltas:
+            await reply.feed(delta)
+        return await reply.finish()
+
+    return channel, asyncio.run(run())
+
+def test_short_reply_edits_placeholder():
+    channel, content = stream(["สวัสดี", " ครับ"])
+    assert content == "สวัสดี ครับ"
+    assert [m.content for m in channel.messages] == ["สวัสดี ครับ"]
+
+def test_rollover_does_not_send_whitespace_only_message():
+    # "\n\n" คร่อมขอบ 2000 ตัวอักษรพอดี
+    first = "ก" * (main.DISCORD_MESSAGE_LIMIT - 1)
+    channel, content = stream([first, "\n\n", "ต่อ"])
+    assert content == first + "\n\nต่อ"
+    assert [m.content for m in channel.messages] == [first, "\n\nต่อ"]
+
+def test_rollover_splits_on_last_whitespace():
+    words = ["คำ" + str(i) for i in range(1000)]
+    deltas = [word + " " for word in words]
+    channel, content = stream(deltas)
+    assert content == " ".join(words)
+    assert len(channel.messages) > 1
+    for message in channel.messages:
+        assert len(message.content) <= main.DISCORD_MESSAGE_LIMIT
+    # ไม่มีคำไหนถูกตัดครึ่งระหว่างข้อความ
+    assert " ".join(m.content.strip() for m in channel.messages).split() == words
+
+def test_edits_are_throttled_per_channel():
+    channel = StubChannel()
+
+    async def run():
+        replies = [main.StreamingReply(channel.send, edit_interval=60, channel_id="room") for _ in range(2)]
+        for reply in replies:
+            await reply.start()
+        for reply in replies:
+            await reply.feed("ข้อความ")
+
+    main.stream_last_edit.pop("room", None)
+    asyncio.run(run())
+    # stream แรก edit ได้ stream ที่สองในห้องเดียวกันต้องรอรอบถัดไป
+    assert channel.edits == ["ข้อความ"]
+
+class FakeStream:
+    """ stream ของ OpenAI ที่ส่ง chunk ตามที่กำหนดแล้ว raise `error` (ถ้ามี) """
+
+    def __init__(self, deltas, error=None):
+        self.deltas = deltas
+        self.error = error
+        self.closed = False
+
+    async def __aiter__(self):
+        for delta in self.deltas:
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+        if self.error is not None:
+            raise self.error
+
+    async def close(self):
+        self.closed = True
+
+def run_openai_stream(monkeypatch, fake, send):
+    async def create_chat_completion(messages, stream=False, **overrides):
+        return fake
+
+    monkeypatch.setattr(main, "create_chat_completion", create_chat_completion)
+    monkeypatch.setattr(main, "openai_health", main.OpenAIHealth())
+    return asyncio.run(main.stream_openai_response(send, [], channel_id="cut"))
+
+def test_interrupted_stream_is_not_returned_as_reply(monkeypatch):
+    channel = StubChannel()
+    error = openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com"))
+    fake = FakeStream(["part1", " part2", " part3"], error)
+    assert run_openai_stream(monkeypatch, fake, channel.send) is None
+    assert fake.closed
+    # ข้อความที่แสดงไปแล้วถูกระบุว่าขาดหาย
+    assert channel.messages[-1].content.endswith(main.STREAM_CUT_OFF_NOTE)
+
+def test_stream_is_closed_when_placeholder_fails(monkeypatch):
+    async def send(content):
+        raise ValueError("discord down")
+
+    fake = FakeStream(["part1"])
+    with pytest.raises(ValueError):
+        run_openai_stream(monkeypatch, fake, send)
+    assert fake.closed
+
+class FailingEditChannel(StubChannel):
+    def check(self, content):
+        if content != main.STREAM_PLACEHOLDER:
+            raise ValueError("edit failed")
+
+def test_stream_is_closed_when_edit_fails(monkeypatch):
+    channel = FailingEditChannel()
+    main.stream_last_edit.pop("cut", None)
+    fake = FakeStream(["part1", " part2"])
+    with pytest.raises(ValueError):
+        run_openai_stream(monkeypatch, fake, channel.send)
+    assert fake.closed